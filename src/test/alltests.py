@@ -25,13 +25,22 @@ from unittest import TestCase
 
 import os
 import sys
+import locale
 from datetime import date
 
 sys.path.append('..') 
 
 from timeflies import Day, Reader, Universe, MonthFilter, main, set_output_destination
+from timeflies import Statistics, load_universe, make_report_options, Rollups, Activity
+from timeflies import SnapshotPublisher, compile_filter, Status, IndexedEngine, verify_engine
+from timeflies import close_text_files, _text_files, Application, load_sqlite, _version
 
 import subprocess
+import json
+import getopt
+import tempfile
+import threading
+import copy
 
 def do_main(cmdline):
     main(cmdline.split(' '))
@@ -64,10 +73,10 @@ class DayTests(TestCase):
     def test_simpleHave(self):
         d = Day('2012-08-05')
         self.assertEqual(d.calc_have(), 0)
-        d.set_hours(8, 17)
-        self.assertEqual(d.calc_have(), 9)
-        d.add_off(1)
-        self.assertEqual(d.calc_have(), 8)
+        d.set_hours(480, 1020)
+        self.assertEqual(d.calc_have(), 540)
+        d.add_off(60)
+        self.assertEqual(d.calc_have(), 480)
 
 class SimpleProject(TestCase):
     def test_read(self):
@@ -108,6 +117,9 @@ class EndToEndTests(TestCase):
     def test_hours_minutes(self):
         self.doit('-t -w hours-minutes.fly', 'hours-minutes.out')
     
+    def test_odd_minutes(self):
+        self.doit('-c -w -a odd-minutes.fly', 'odd-minutes.out')
+    
     def test_reset(self):
         self.doit('-t reset-test.fly', 'reset-test.out')
     
@@ -156,11 +168,26 @@ class EndToEndTests(TestCase):
     def test_missing_file(self):
         self.doit('-b this-file-does-not-exist.fly', 'this-file-does-not-exist.out')
     
+    def test_json_messages(self):
+        run = subprocess.run([sys.executable, '../timeflies.py', '--message-format', 'json', '-t',
+                              'error-test.fly', 'this-file-does-not-exist.fly'], capture_output=True, text=True)
+        self.assertTrue(run.stdout.startswith('Time at work overview'))
+        report = json.loads(run.stderr)
+        self.assertEqual(report['errors'] + report['warnings'], len(report['messages']))
+        self.assertEqual('open-failed', report['messages'][-1]['code'])
+    
     def test_missing_import_file(self):
         self.doit('-b imports/missing-import.fly', 'imports/missing-import.out')
     
     def test_bad_filter_option(self):
         self.doit('-b -c -f bad-filter-string bad-filter-option.fly', 'bad-filter-option.out')
+
+    def test_filter_algebra_1(self):
+        self.doit('-t -c -w -f 2012-11,-phol,mon..fri filter-algebra.fly', 'filter-algebra-1.out')
+    
+    def test_filter_algebra_2(self):
+        self.doit('-t -w -a -f 2012-10..2012-12,-2012-11-05..2012-11-30,-sat filter-algebra.fly',
+                  'filter-algebra-2.out')
     
     def test_public_holiday_on_weekend(self):
         self.doit('-t public-holiday-on-weekend.fly', 'public-holiday-on-weekend.out')
@@ -194,7 +221,331 @@ class EndToEndTests(TestCase):
 
     def test_default_sick_and_leave(self):
         self.doit('-t default-leave-and-sick.fly', 'default-leave-and-sick.out')
+
+    def test_compressed_imports(self):
+        self.doit('-b -t -w compressed/archive.fly', 'compressed/archive.out')
+
+    def test_broken_compressed_files(self):
+        self.doit('-b -t compressed/truncated.fly.gz compressed/corrupt.fly.gz '
+                  'compressed/truncated.fly.bz2 compressed/corrupt.fly.bz2', 'compressed/broken.out')
+
+    def test_sqlite_round_trip(self):
+        self.doit('--export-sqlite sqlite-test.db test-4.fly', 'sqlite-export.out')
+        self.doit('-t -f week --from-sqlite sqlite-test.db', 'test-4a.out')
+        u = load_sqlite('sqlite-test.db', dayfilter=compile_filter(['2012-09-04..2012-09-06'])[0])
+        self.assertEqual(['2012-09-03', '2012-09-04', '2012-09-05', '2012-09-06', '2012-09-07'],
+                         sorted(u.anonymous.days))
+        os.remove('sqlite-test.db')
+        app = Application(Universe())
+        self.assertRaises(getopt.GetoptError, app._parse_cmdline, ['run', '--from-sqlite', 'x.db', 'test-4.fly'])
+
+    def test_report_cache(self):
+        self.doit('--cache report-cache -t test-5.fly', 'test-5.out')
+        self.assertEqual(len(os.listdir('report-cache')), 1)
+        self.doit('--cache report-cache -t test-5.fly', 'test-5.out')
+        self.doit('--cache report-cache --engine indexed -t test-5.fly', 'test-5.out')
+        self.assertEqual(len(os.listdir('report-cache')), 2)
+        self.doit('--cache report-cache --cache-size 0 -t -w test-5.fly', 'test-5-w.out')
+        self.assertEqual(os.listdir('report-cache'), [])
+        os.rmdir('report-cache')
+        
+        with open('not-a-folder', 'w'):
+            pass
+        self.addCleanup(os.remove, 'not-a-folder')
+        self.doit('--cache not-a-folder -t test-5.fly', 'cache-failed.out')
+
+    def test_batch(self):
+        for workers in ('1', '2'):
+            self.doit('-j ' + workers + ' --batch batch/queries.txt test-4.fly', 'batch/batch.out')
+            for report, expected in (('batch-4a.txt', 'test-4a.out'), ('batch-4b.txt', 'test-4b.out')):
+                with open(report) as f, open(expected) as g:
+                    self.assertEqual(f.read(), g.read())
+                os.remove(report)
+
+    def test_table_import(self):
+        self.doit('-t -c -w -a -C table/table.fly', 'table/table.out')
+
+    def test_archive(self):
+        self.doit('--compile-archive archive-test.tfa -f 2012-07-01..2012-08-31 test-5.fly', 'archive/compile.out')
+        self.doit('-t archive/test-5-rest.fly', 'test-5.out')
+        os.remove('archive-test.tfa')
+        self.doit('--compile-archive archive-test.tfa.gz -f 2012-07-01..2012-08-31 test-5.fly',
+                  'archive/compile-gz.out')
+        self.doit('-t archive/test-5-rest-gz.fly', 'test-5.out')
+        os.remove('archive-test.tfa.gz')
+
+    def test_check_incremental(self):
+        self.doit('--check-incremental -f 2012-09 reset-test.fly', 'check-incremental.out')
+
+    def test_lint(self):
+        self.doit('--lint -j 2 error-test.fly invalid-activities.fly reread-test.fly day-defined-again.fly '
+                  'table/table.fly', 'lint.out')
+
+    def test_chunked(self):
+        self.doit('--chunk-days 3 -j 2 -t reset-test.fly', 'reset-test.out')
+        self.doit('--chunk-days 2 -t test-must-hours.fly', 'test-must-hours.out')
+        self.doit('--chunk-days 4 -j 2 -c check-days-test.fly', 'check-days-test.out')
+    
+    def test_work_package_depth(self):
+        self.doit('-w -a --depth 3 --min-hours 1 wp-depth.fly', 'wp-depth.out')
+
+    def test_top_work_packages(self):
+        self.doit('--top 3 --subtrees -f 2012-11-19..2012-11-19 wp-depth.fly', 'wp-top.out')
+
+    def test_plan_vs_actual(self):
+        self.doit('--plan-vs-actual plan-vs-actual.fly', 'plan-vs-actual.out')
+
+    def test_rolling_window(self):
+        self.doit('-t -f week --rolling 2w reset-test.fly', 'rolling.out')
+        # the days before the filter's range still count for the window
+        self.doit('-t --rolling 2w -f 2012-09-10..2012-09-30 reset-test.fly', 'rolling-filtered.out')
+
+    def test_search(self):
+        self.doit('--search acme-4711 search-test.fly', 'search-test.out')
+
+    def test_search_filtered(self):
+        self.doit('--search Printer -f 2012-11-19..2012-11-19 search-test.fly', 'search-test-2.out')
+
+    def test_team(self):
+        self.doit('-t -c -w team/team.fly', 'team/team.out')
+
+    def test_team_workers(self):
+        self.doit('-j 2 -t -c -w team/team.fly', 'team/team.out')
+
+    def test_verify_engine(self):
+        self.doit('--engine indexed --verify-engine -a -f 2012-11,-phol team/team.fly', 'team/verify-engine.out')
+        self.doit('--engine indexed -j 2 -t -c -w team/team.fly', 'team/team.out')
+
+    def test_message_limit(self):
+        self.doit('--message-limit 3 -t message-limit.fly', 'message-limit.out')
+
+    @unittest.skipUnless(locale.getpreferredencoding(False).lower().replace('-', '') == 'utf8',
+                         'needs a UTF-8 locale')
+    def test_bad_encoding(self):
+        self.doit('-t bad-encoding.fly', 'bad-encoding.out')
+        self.doit('--lint bad-encoding.fly', 'bad-encoding-lint.out')
+        
+class LibraryTests(TestCase):
+    files = { 'wps.fly': 'wp p\n    a\n    b\n',
+              'log.fly': 'import wps.fly\nday 2012-11-19 8 17\n- p.a 6\n- p.c 1\n- p.b 2.5\n' }
+
+    def test_load_from_strings(self):
+        u = load_universe(['log.fly'], loader=lambda path: self.files[path])
+        self.assertEqual(1, u.diagnostics.errors)
+        self.assertEqual('unknown-work-package', u.diagnostics.messages[0].code)
+        self.assertEqual(4, u.diagnostics.messages[0].line)
+        
+        options, bad = make_report_options('2012-11')
+        self.assertEqual([], bad)
+        rows = list(Statistics(u.anonymous).tally(options))
+        self.assertEqual(['day', 'week', 'month', 'total'], [r.kind for r in rows])
+        self.assertEqual(540, rows[0].worked)
+        self.assertEqual('2012-11-19 Mon:    9.00 ----.-- ----.--    1.00', rows[0].format())
         
+        problems = list(Statistics(u.anonymous).check(options['time']))
+        self.assertEqual(1, len(problems))
+        self.assertEqual(510, problems[0].amount)
+        
+        act = u.workpackage_root.calc_activity(options['time'])
+        self.assertEqual(150, act.get_node('p.b').value)
+
+    def test_load_from_lines(self):
+        u = load_universe([('in-memory', ['wp x', 'day 2012-11-20 9 12', '- x 3'])])
+        self.assertEqual(0, u.diagnostics.errors)
+        self.assertEqual(180, u.workpackage_root.calc_activity(make_report_options()[0]['time']).value)
+
+    def test_rollups(self):
+        u = load_universe([('in-memory', ['wp x', '    y', 'day 2012-11-20 9 12', '- x.y 3',
+                                          'day 2012-11-21 9 17', '- x 8'])])
+        rollups = Rollups(u)
+        self.assertEqual([480, 660], rollups.workpackages[u.get_workpackage('x')])
+        
+        day = Day('2012-11-22')
+        day.set_hours(480, 960)
+        activity = Activity(480, None)
+        activity.attach_to(u.get_workpackage('x.y'))
+        activity.attach_to(day)
+        rollups.add_day(u.anonymous, day)
+        self.assertEqual([660, 660], rollups.workpackages[u.get_workpackage('x.y')])
+        self.assertEqual([480, 1140], rollups.workpackages[u.get_workpackage('x')])
+        
+        rollups.remove_day(u.anonymous, '2012-11-20')
+        self.assertEqual([480, 480], rollups.workpackages[u.get_workpackage('x.y')])
+        self.assertEqual(960, rollups.periods[(None, 'month', 201211)].tally_row(None).worked)
+        self.assertEqual([], rollups.check())
+        
+        # 2012-12-31 is in ISO week 2013-01, so its month key is 201312
+        u = load_universe([('new-year', ['day 2012-12-28 8 17', 'day 2012-12-31 8 16',
+                                         'day 2013-01-02 8 15', 'day 2013-12-02 8 14'])])
+        rollups = Rollups(u)
+        self.assertEqual(540, rollups.periods[(None, 'month', 201212)].tally_row(None).worked)
+        self.assertEqual(840, rollups.periods[(None, 'month', 201312)].tally_row(None).worked)
+        rollups.remove_day(u.anonymous, '2012-12-31')
+        self.assertEqual(360, rollups.periods[(None, 'month', 201312)].tally_row(None).worked)
+        self.assertEqual(420, rollups.periods[(None, 'week', 201301)].tally_row(None).worked)
+        self.assertEqual([], rollups.check())
+        
+        # the totals of people with directives are kept in segments
+        u = load_universe([('directives', [ 'day 2012-11-%02d 8 17' % d for d in range(5, 30) if d % 7 != 3 ] +
+                                          [ 'day 2012-11-14', 'reset', 'day 2012-11-21', 'add-leave 8',
+                                            'day 2012-11-28', 'balance-must 16' ])])
+        rollups = Rollups(u)
+        for datestring in '2012-11-05', '2012-11-14', '2012-11-19', '2012-11-21', '2012-11-29':
+            day = rollups.remove_day(u.anonymous, datestring)
+            self.assertEqual([], rollups.check())
+            rollups.add_day(u.anonymous, day)
+            self.assertEqual([], rollups.check())
+
+    def test_activity_order(self):
+        u = load_universe([('late', ['wp x', 'day 2012-11-21', '- x 1; c', 'day 2012-11-22', '- x 1; d']),
+                           ('early', ['day 2012-11-20', '- x 1; a', '- x 2; b', 'day 2012-11-21', '- x 1; e'])])
+        self.assertEqual(['a', 'b', 'c', 'e', 'd'], [a.description for a in u.get_workpackage('x').activities])
+
+    def test_snapshots(self):
+        publisher = SnapshotPublisher(['team/team.fly'])
+        publisher.refresh(wait=True)
+        first = publisher.current
+        self.assertRaises(AttributeError, setattr, first, 'people', ())
+        
+        expected = first.report(['-j', '2', '-t', '-c', '-w'])
+        with open('team/team.out') as f:
+            self.assertEqual(f.read(), expected)
+        self.assertRaises(ValueError, first.report, ['--check-incremental'])
+        self.assertRaises(ValueError, first.report, ['--top', '0'])
+        self.assertRaises(ValueError, first.report, ['--depth', 'x'])
+        self.assertTrue(first.report(['-h']).startswith('\n  Usage: report '))
+        self.assertEqual(_version + '\n', first.report(['--version']))
+        
+        reports = [ None ] * 8
+        def query(i):
+            reports[i] = publisher.current.report(['-j', '2', '-t', '-c', '-w'])
+        threads = [ threading.Thread(target=query, args=(i,)) for i in range(len(reports)) ]
+        publisher.refresh()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([expected] * len(reports), reports)
+        
+        publisher.refresh(wait=True)
+        self.assertTrue(publisher.current.generation > first.generation)
+        self.assertEqual(expected, first.report(['-j', '2', '-t', '-c', '-w']))
+
+    def test_mapped_read(self):
+        text = ('wp p ; # top\n    a # sub-package\n\t\n    # end of definition\n    b\n'
+                'day 2012-11-19 8 17 \t# monday\n- p.a 6 ; one # two\n- p.b 2.5 ; ' + chr(228) + ' ')
+        for newline in '\n', '\r\n':
+            with open('mapped-test.fly', 'w', encoding='utf-8', newline='') as f:
+                f.write(text.replace('\n', newline))
+            mapped = load_universe(['mapped-test.fly'])
+            os.remove('mapped-test.fly')
+            parsed = load_universe([('mapped-test.fly', text)])
+            
+            self.assertEqual([(m.line, m.text) for m in parsed.diagnostics.messages],
+                             [(m.line, m.text) for m in mapped.diagnostics.messages])
+            self.assertEqual(2, len(mapped.diagnostics.messages))
+            self.assertEqual([(360, 'one')], [(a.duration, a.description)
+                                              for a in mapped.get_workpackage('p.a').activities])
+            self.assertEqual(None, mapped.get_workpackage('p.a').description)
+            self.assertEqual(None, mapped.get_workpackage('p.b'))
+
+    def test_status_segments(self):
+        u = load_universe([('days', ['day 2012-11-%02d 8 17, off 1' % d for d in range(5, 10)] +
+                                    ['day 2012-11-07', 'reset', 'day 2012-11-08', 'must-hours 60'])])
+        days = u.anonymous.get_chrono_days()
+        whole = Status('total')
+        for d in days:
+            whole.process_day(d)
+        
+        segments = []
+        for chunk in days[:2], days[2:3], days[3:]:
+            segment = Status('total')
+            segment.start_segment()
+            for d in chunk:
+                segment.process_day(d)
+            segments.append(segment)
+        
+        left = Status('total')
+        for segment in segments:
+            left.combine(segment)
+        right = copy.copy(segments[1])
+        right.combine(segments[2])
+        grouped = Status('total')
+        grouped.combine(segments[0])
+        grouped.combine(right)
+        self.assertEqual(whole.values(), left.values())
+        self.assertEqual(whole.values(), grouped.values())
+    
+    def test_engines(self):
+        u = load_universe(['team/team.fly'])
+        options = make_report_options('2012-11-19..2012-11-21', dict(u.dump_options))[0]
+        options['activities'] = True
+        self.assertTrue(all(difference is None for title, lines, difference
+                            in verify_engine(IndexedEngine(u, 2), options)))
+        
+        class SilentEngine(IndexedEngine):
+            name = 'silent'
+            def check(self, identity, dayfilter):
+                return []
+        
+        results = verify_engine(SilentEngine(u), options)
+        self.assertEqual([('day check of bob', 2, (1, '2012-11-20 Tue: worked  9.00, allocated  7.00, delta -2.00',
+                                                   'ok.'))],
+                         [ r for r in results if r[2] is not None ])
+    
+    def test_compile_filter(self):
+        def days(spec):
+            dayfilter, bad = compile_filter(spec.split(','))
+            self.assertEqual([], bad)
+            return [ (str(date.fromordinal(first)), str(date.fromordinal(last)))
+                     for first, last in dayfilter.intervals ]
+        
+        self.assertEqual([('2012-01-01', '2012-03-31'), ('2012-07-01', '2012-09-30')], days('2012-Q1,2012-Q3'))
+        self.assertEqual([('2012-01-01', '2012-02-29'), ('2012-04-01', '2012-04-30')],
+                         days('2012-02,2012-04,2012-01'))
+        self.assertEqual([('2012-03-01', '2012-12-23')], days('2012-03..2012-Q4,-2012-12-24..2013-01-06'))
+        self.assertEqual([], days('2012-07,-2012'))
+        self.assertEqual(0x1f, compile_filter(['-sat', '-sun'])[0].weekdays)
+        self.assertEqual(0x71, compile_filter(['fri..mon'])[0].weekdays)
+        self.assertEqual(['2012-13', '2012-05..2012-04', 'moon'],
+                         compile_filter(['2012-13', '2012-05..2012-04', 'moon'])[1])
+        
+        u = load_universe([('days', [ 'day 2012-11-%02d 8 17' % d for d in range(1, 31) if d != 12 ] +
+                                    [ 'day 2012-11-12', 'phol' ])])
+        dayfilter = compile_filter(['2012-11-05..2012-11-20', 'mon', 'wed', '-phol'])[0]
+        index = u.anonymous.day_index
+        self.assertEqual([ i for i, d in enumerate(index.days) if dayfilter.passes(d) ],
+                         list(dayfilter.select(index)))
+        self.assertEqual([4, 6, 13, 18], list(dayfilter.select(index)))
+    
+    def test_lazy_text(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        path = os.path.join(folder.name, 'lazy-test.fly')
+        text = ('wp p\nday 2012-11-19 8 17\n; first ' + chr(228) + '\n; second\n'
+                '- p 6 ; one # two\n- p 2 ; ' + chr(8364) + ' three\n- p 1\n')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        lazy = load_universe([path], lazy_text=True)
+        plain = load_universe([path])
+        self.addCleanup(close_text_files)
+        
+        activities = lazy.get_workpackage('p').activities
+        self.assertTrue(isinstance(activities[0]._description, int))
+        self.assertEqual(['one', chr(8364) + ' three', None], [a.description for a in activities])
+        day = '2012-11-19'
+        self.assertEqual(plain.anonymous.days[day].comments, lazy.anonymous.days[day].comments)
+        
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('- p 1 ; four\n')
+        self.assertRaises(ValueError, lambda: activities[0].description)
+        
+        files = len(_text_files)
+        again = load_universe([path], lazy_text=True)
+        self.assertEqual(files, len(_text_files))
+        self.assertRaises(ValueError, lambda: activities[0].description)
+        self.assertEqual('four', again.get_workpackage('p').activities[3].description)
+
 class CalcActivitiesByMonth(TestCase):
     def test_read(self):
         self.u = Universe()
@@ -209,13 +560,13 @@ class CalcActivitiesByMonth(TestCase):
         a = p2.activities[1]
         self.assertEqual(date(2012, 7, 14), a.day().date)
         act = self.doStats(7)
-        self.assertEqual(2.0, act.get_node('project.sub1.aa').value)
-        self.assertEqual(3.0, act.get_node('project.sub3').value)
-        self.assertEqual(10.0, act.get_node('project.sub2').value)
+        self.assertEqual(120, act.get_node('project.sub1.aa').value)
+        self.assertEqual(180, act.get_node('project.sub3').value)
+        self.assertEqual(600, act.get_node('project.sub2').value)
         act = self.doStats(8)
-        self.assertEqual(1.5, act.get_node('project.sub1.aa').value)
-        self.assertEqual(4.0, act.get_node('project.sub1').value)
-        self.assertEqual(4.5, act.get_node('project.sub2').value)
+        self.assertEqual(90, act.get_node('project.sub1.aa').value)
+        self.assertEqual(240, act.get_node('project.sub1').value)
+        self.assertEqual(270, act.get_node('project.sub2').value)
         act = self.doStats(9)
    
     def doStats(self, month):
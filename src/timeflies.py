@@ -29,29 +29,70 @@ import weakref
 import sys
 import getopt
 import os.path
+import json
+import io
+import contextlib
+import gzip
+import zlib
+import bz2
+import lzma
+import sqlite3
+import heapq
+import collections
+import bisect
+import array
+import struct
+import csv
+import hashlib
+import mmap
+import codecs
+import locale
+import shlex
+import multiprocessing
+import threading
+import copy
+import itertools
 
 _outputdest = sys.stdout
+_threadoutput = threading.local()
 
 def set_output_destination(dest):
     global _outputdest
     _outputdest = dest
 
-def output(text=None, dest=None):
+@contextlib.contextmanager
+def output_to(dest):
+    '''Direct the output of the current thread to dest within the with
+    statement, whatever the output destination of the other threads.'''
+    saved = getattr(_threadoutput, 'dest', None)
+    _threadoutput.dest = dest
+    try:
+        yield dest
+    finally:
+        _threadoutput.dest = saved
+
+def output(text=None, dest=None, end='\n'):
     if text is None:
         text = ''
     if dest is None:
-        dest = _outputdest
-    print(text, file=dest)
+        dest = getattr(_threadoutput, 'dest', None)
+        if dest is None:
+            dest = _outputdest
+    print(text, file=dest, end=end)
 
-def plural(number, unit, plural='s'):
-    pl = '' if number == 1 else plural   
+def plural(number, unit, plural='s', singular=''):
+    pl = singular if number == 1 else plural
     num = 'no' if number == 0 else str(number) 
     return num + ' ' + unit + pl
 
+_whitespace = re.compile(r'\s+')
+_hours_minutes = re.compile(r'^\d+:\d\d$')
+_decimal_hours = re.compile(r'^\d+(\.\d{1,2})?$')
+
 def tidy_whitespace(mess):
     '''Truncates leading and trailing white spaces and
     replaces each other sequence of white spaces by a single space.'''
-    return re.sub('\s+', ' ', mess.strip())
+    return _whitespace.sub(' ', mess.strip())
 
 def make_date(dstr):
     '''Create a date object out of a string of the form
@@ -60,66 +101,368 @@ def make_date(dstr):
     return date(int(year), int(month), int(day))
 
 def make_time(tstr):
-    if re.match('^\d+:\d\d$', tstr):
+    '''Convert a time string of the form H:MM or H[.hh] into an
+    integer number of minutes and return it. Decimal hours are
+    rounded to the nearest minute. Returns None if the string is
+    malformed.'''
+    if _hours_minutes.match(tstr):
         hours, minutes = tstr.split(':')
-        return float(hours) + (float(minutes) / 60.0)
-    elif re.match('^\d+(\.\d{1,2})?$', tstr):
-        return float(tstr)
+        return int(hours) * 60 + int(minutes)
+    elif _decimal_hours.match(tstr):
+        hours, dot, fraction = tstr.partition('.')
+        hundredths = int(fraction.ljust(2, '0')) if dot == '.' else 0
+        return int(hours) * 60 + (hundredths * 60 + 50) // 100
     else:
         return None
 
+def hours(minutes):
+    '''Convert an integer number of minutes into (float) hours for
+    printing.'''
+    return minutes / 60
+
+def format_hours(minutes):
+    '''Format an integer number of minutes as hours, rounded to two
+    decimals like they are written in the input (8.0, 1.5, 0.33).'''
+    return str(round(minutes / 60, 2))
+
+def join_comments(comment, more):
+    if more is None:
+        return comment
+    return more if comment is None else comment + '; ' + more
+
 day_map = { 'mon':0, 'tue':1, 'wed':2, 'thu':3, 'fri':4, 'sat':5, 'sun':6 }
 
+day_names = ( 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun' )
+
+def format_date(dt):
+    '''Format a date as YYYY-MM-DD Www.'''
+    return dt.isoformat() + ' ' + day_names[dt.weekday()]
+
+def format_period_key(key):
+    '''Turn a period key of the form YYYYNN (as used in DayIndex)
+    into a YYYY-NN label.'''
+    if key is None:
+        return None
+    return '{0:d}-{1:02d}'.format(key // 100, key % 100)
+
 def is_weekend(day):
     '''Return True if the given date is a Saturday or a Sunday,
     False otherwise.'''
     return day.weekday() == 5 or day.weekday() == 6
 
 def format_floatval(val):
-    if val == 0.0:
+    '''Format a number of minutes as hours.'''
+    if val == 0:
         return '----.--'
     else:
-        return '{0:7.2f}'.format(val)
+        return '{0:7.2f}'.format(hours(val))
 
-def dump_day_header():
-    output('{0:^15s} {1:>7s} {2:>7s} {3:>7s} {4:>7s}'.format('when', 'worked', 'leave', 'sick', 'balance'))
+def dump_day_header(rolling=False):
+    header = '{0:^15s} {1:>7s} {2:>7s} {3:>7s} {4:>7s}'.format('when', 'worked', 'leave', 'sick', 'balance')
+    if rolling:
+        header += ' {0:>7s} {1:>7s}'.format('wrk/wk', 'bal/wk')
+    output(header)
 
-class AllFilter:
-    def passes(self, day):
-        return True
+def dump_tally(rows, options):
+    '''Print the TallyRows of a time at work overview between headers.'''
+    rolling = 'rolling' in options
+    dump_day_header(rolling)
+    
+    for row in rows:
+        row.dump(options)
+    
+    dump_day_header(rolling)
 
-class RangeFilter:
-    def __init__(self, starty, startm, startd, endy, endm, endd):
-        self._start = date(starty, startm, startd).toordinal()
-        self._end = date(endy, endm, endd).toordinal()
+def dump_problems(problems):
+    '''Print the DayProblems of a day check and their number.'''
+    warnings = 0
+    for problem in problems:
+        output(problem.format())
+        warnings += 1
+
+    if warnings != 0:
+        output(plural(warnings, 'problem') + ' detected.')
+    else:
+        output('ok.')
+
+def make_window(arg):
+    '''Turn a window length of the form <n>w (weeks) or <n>[d] (days)
+    into a number of days. Returns None if the argument is bad.'''
+    m = re.match('^(\\d+)([wd]?)$', arg)
+    if m is None or int(m.group(1)) == 0:
+        return None
+    return int(m.group(1)) * (7 if m.group(2) == 'w' else 1)
+
+# The last day ordinal and the names of the weekdays, Monday first.
+_max_ordinal = date.max.toordinal()
+_weekday_names = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+def normalise_intervals(intervals):
+    '''Sort (first, last) day ordinal intervals and merge the ones that
+    overlap or touch.'''
+    merged = []
+    for first, last in sorted(intervals):
+        if len(merged) > 0 and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+def subtract_intervals(intervals, excluded):
+    '''The parts of normalised intervals not in the excluded ones.'''
+    result = []
+    excluded = normalise_intervals(excluded)
+    for first, last in intervals:
+        for xfirst, xlast in excluded:
+            if xlast < first or xfirst > last:
+                continue
+            if xfirst > first:
+                result.append((first, xfirst - 1))
+            first = xlast + 1
+            if first > last:
+                break
+        if first <= last:
+            result.append((first, last))
+    return result
+
+class DayFilter:
+    '''A set of days to process: sorted, disjoint day ordinal intervals
+    (None for no bounds), a bit mask of the weekdays (bit 0 is Monday,
+    None for all) and whether public holidays pass (None: both ways,
+    True: only they, False: not they). Membership is a bisect over the
+    interval starts.'''
+    def __init__(self, intervals=None, weekdays=None, holidays=None):
+        self.intervals = None if intervals is None else normalise_intervals(intervals)
+        self.weekdays = weekdays
+        self.holidays = holidays
+        if self.intervals is not None:
+            self._starts = [ first for first, last in self.intervals ]
+            self._ends = [ last for first, last in self.intervals ]
+    
+    def covers(self, ordinal):
+        '''Whether the day of the ordinal is within the intervals and on
+        one of the weekdays.'''
+        if self.intervals is not None:
+            i = bisect.bisect_right(self._starts, ordinal)
+            if i == 0 or ordinal > self._ends[i - 1]:
+                return False
+        return self.weekdays is None or (self.weekdays >> ((ordinal - 1) % 7)) & 1 == 1
     
     def passes(self, day):
-        ordinal = day.date.toordinal()
-        return self._start <= ordinal and ordinal <= self._end
+        if self.holidays is not None and self.holidays != (day.phol is not None):
+            return False
+        return self.covers(day.date.toordinal())
+    
+    def ordinal_range(self):
+        '''The first and last day ordinals that can pass the filter, or
+        None if there are no bounds.'''
+        if self.intervals is None:
+            return None
+        elif len(self.intervals) == 0:
+            return 1, 0
+        return self._starts[0], self._ends[-1]
+    
+    def _spans(self, first, last):
+        '''The parts of the intervals from ordinal first to last.'''
+        if self.intervals is None:
+            return [ (first, last) ] if first <= last else []
+        i = max(0, bisect.bisect_right(self._starts, first) - 1)
+        spans = []
+        while i < len(self.intervals) and self._starts[i] <= last:
+            if self._ends[i] >= first:
+                spans.append((max(first, self._starts[i]), min(last, self._ends[i])))
+            i += 1
+        return spans
+    
+    def covered(self, first, last):
+        '''Generate the ordinals from first to last of the days without
+        record (that is, no public holidays) that pass the filter.'''
+        if self.holidays:
+            return
+        for start, end in self._spans(first, last):
+            if self.weekdays is None:
+                yield from range(start, end + 1)
+            else:
+                for ordinal in range(start, end + 1):
+                    if (self.weekdays >> ((ordinal - 1) % 7)) & 1 == 1:
+                        yield ordinal
+    
+    def select(self, index):
+        '''Generate the positions of the days of a DayIndex that pass
+        the filter, in order. Only the days within the intervals are
+        looked at.'''
+        ordinals = index.ordinals
+        if self.intervals is None:
+            positions = range(len(ordinals))
+        else:
+            positions = itertools.chain.from_iterable(
+                range(bisect.bisect_left(ordinals, first), bisect.bisect_right(ordinals, last))
+                for first, last in self.intervals)
         
-class MonthFilter:
+        weekdays = self.weekdays
+        holidays = self.holidays
+        if weekdays is None and holidays is None:
+            yield from positions
+            return
+        for i in positions:
+            if weekdays is not None and not (weekdays >> ((ordinals[i] - 1) % 7)) & 1:
+                continue
+            if holidays is not None and holidays != (index.days[i].phol is not None):
+                continue
+            yield i
+
+class AllFilter(DayFilter):
+    def passes(self, day):
+        return True
+
+class RangeFilter(DayFilter):
+    def __init__(self, starty, startm, startd, endy, endm, endd):
+        DayFilter.__init__(self, [ (date(starty, startm, startd).toordinal(),
+                                    date(endy, endm, endd).toordinal()) ])
+
+def month_interval(year, month):
+    '''The first and last day ordinals of a month.'''
+    first = date(year, month, 1)
+    if month == 12:
+        following = date(year + 1, 1, 1)
+    else:
+        following = date(year, month + 1, 1)
+    return first.toordinal(), following.toordinal() - 1
+
+class MonthFilter(DayFilter):
     def __init__(self, year, month):
-        self._year = year
-        self._month = month
+        DayFilter.__init__(self, [ month_interval(year, month) ])
+
+def _filter_days(arg):
+    '''The day ordinal interval of a filter item naming a year, a
+    quarter, a month, a day or a range of these, None if it names
+    none.'''
+    if '..' in arg:
+        start, end = arg.split('..', 1)
+        start, end = _filter_days(start), _filter_days(end)
+        if start is None or end is None or start[0] > end[1]:
+            return None
+        return start[0], end[1]
     
-    def passes(self, day):
-        return day.date.year == self._year and day.date.month == self._month
+    try:
+        if re.match('^\\d{4}$', arg):
+            return date(int(arg), 1, 1).toordinal(), date(int(arg), 12, 31).toordinal()
+        elif re.match('^\\d{4}-Q[1-4]$', arg):
+            year, quarter = int(arg[:4]), int(arg[6])
+            return month_interval(year, quarter * 3 - 2)[0], month_interval(year, quarter * 3)[1]
+        elif re.match('^\\d{4}-\\d{2}$', arg):
+            return month_interval(int(arg[:4]), int(arg[5:]))
+        elif re.match('^\\d{4}-\\d{2}-\\d{2}$', arg):
+            ordinal = date(int(arg[:4]), int(arg[5:7]), int(arg[8:])).toordinal()
+            return ordinal, ordinal
+    except ValueError:
+        pass
+    return None
+
+def _filter_weekdays(arg):
+    '''The weekday bit mask of a filter item naming a weekday or a
+    range of weekdays (like mon..fri), None if it names none.'''
+    first, sep, last = arg.partition('..')
+    if first not in _weekday_names or (sep and last not in _weekday_names):
+        return None
+    first = _weekday_names.index(first)
+    last = _weekday_names.index(last) if sep else first
+    mask = 0
+    for i in range(7):
+        if (i - first) % 7 <= (last - first) % 7:
+            mask |= 1 << i
+    return mask
+
+def compile_filter(items):
+    '''Compile filter items as accepted by option -f into a DayFilter.
+    The days of the date items ('all', YYYY, YYYY-Qn, YYYY-MM,
+    YYYY-MM-DD and ranges first..last of these) are united, weekday
+    items (mon, ..., sun and ranges like mon..fri) restrict the days
+    to these weekdays, and 'phol' to the public holidays. An item with
+    a leading '-' excludes its days instead. Returns the filter and a
+    list of the bad items.'''
+    included = None
+    excluded = []
+    weekdays = None
+    exclude_weekdays = 0
+    holidays = None
+    bad = []
+    
+    for item in items:
+        exclude = item.startswith('-')
+        arg = item[1:] if exclude else item
+        days = (1, _max_ordinal) if arg == 'all' else _filter_days(arg)
+        mask = _filter_weekdays(arg)
+        if days is not None:
+            if exclude:
+                excluded.append(days)
+            elif included is None:
+                included = [ days ]
+            else:
+                included.append(days)
+        elif mask is not None:
+            if exclude:
+                exclude_weekdays |= mask
+            else:
+                weekdays = (weekdays or 0) | mask
+        elif arg == 'phol':
+            holidays = not exclude
+        else:
+            bad.append(item)
+    
+    if len(excluded) > 0:
+        included = subtract_intervals(normalise_intervals(included or [ (1, _max_ordinal) ]), excluded)
+    elif included is not None and normalise_intervals(included) == [ (1, _max_ordinal) ]:
+        included = None
+    if exclude_weekdays != 0:
+        weekdays = (0x7f if weekdays is None else weekdays) & ~exclude_weekdays
+    
+    if included is None and weekdays is None and holidays is None:
+        return AllFilter(), bad
+    return DayFilter(included, weekdays, holidays), bad
 
 def make_filter(arg):
-    if arg == 'all':
-        return AllFilter()
-    elif re.match('^\d{4}-\d{2}$', arg):
-        year, month = arg.split('-')
-        return MonthFilter(int(year), int(month))
-    elif re.match('^\d{4}(-\d{2}){2}\.\.\d{4}(-\d{2}){2}$', arg):
-        startstring, endstring = arg.split('..')
-        starty, startm, startd = startstring.split('-')
-        endy, endm, endd = endstring.split('-')        
-        return RangeFilter(int(starty), int(startm), int(startd),
-                           int(endy), int(endm), int(endd))
+    '''The DayFilter of a comma separated list of filter items, None
+    if any of them is bad.'''
+    dayfilter, bad = compile_filter(arg.split(','))
+    return None if len(bad) > 0 else dayfilter
+
+def make_report_options(filterspec='all', options=None):
+    '''Turn a filter specification as accepted by option -f into the
+    report options used by Statistics and WorkPackage.calc_activity():
+    'time' (the time filter) and the summary cycles 'day', 'week' and
+    'month'. The options are added to the given dict, if any. Returns
+    the options and a list of the bad filter items.'''
+    if options is None:
+        options = {}
+    
+    stats_day = False
+    stats_week = False
+    stats_month = False
+    
+    items = []
+    for flt in filterspec.split(','):
+        if flt == 'day':
+            stats_day = True
+        elif flt == 'week':
+            stats_week = True
+        elif flt == 'month':
+            stats_month = True
+        else:
+            items.append(flt)
+    
+    options['time'], bad = compile_filter(items)
+        
+    if not stats_week and not stats_month:
+        for kind in ['day', 'week', 'month']:
+            options[kind] = True
     else:
-        output('Bad time filter argument: ' + arg)
-        return None
+        options['day'] = stats_day
+        options['week'] = stats_week
+        options['month'] = stats_month
+    
+    return options, bad
 
 class Node:
     def __init__(self):
@@ -185,12 +528,16 @@ class Node:
                 c.dump(options, indent)
     
     def tidy_up(self):
-        if self.activities is not None:
-            self.activities.sort(key=lambda a: a.day().date)
+        '''Put the activities of this node and all nodes below it in
+        order.'''
+        self.order_activities()
         
         if self._children is not None:
             for c in self._children:
                 c.tidy_up()
+    
+    def order_activities(self):
+        pass
         
     def create_node(self, name):
         pass
@@ -205,32 +552,138 @@ def dump_activities(activities, indent, options):
     if activities is not None:
         for a in activities:
             comment = '' if a.description is None else ('; ' + a.description)
-            output(indent + '- ' + str(a.day().date) + ' ' + str(a.duration) + comment)
+            output(indent + '- ' + str(a.day().date) + ' ' + format_hours(a.duration) + comment)
 
-class ValueNode(Node):
-    def __init__(self, workpackage, value=None):
-        Node.__init__(self)
-        self.value = value
+class TopList:
+    '''Keeps the n items with the largest values offered to it in a
+    bounded heap. Of items with equal values the ones offered first
+    win.'''
+    def __init__(self, n):
+        self._n = n
+        self._heap = []
+        self._seq = 0
+    
+    def offer(self, value, item):
+        entry = (value, -self._seq, item)
+        self._seq += 1
+        if len(self._heap) < self._n:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+    
+    def items(self):
+        '''The (value, item) pairs kept, largest value first.'''
+        return [ (e[0], e[2]) for e in sorted(self._heap, key=lambda e: e[:2], reverse=True) ]
+
+class ValueNode:
+    '''A node of the result tree built by WorkPackage.calc_activity().
+    A light-weight relative of Node: no parent reference and no name
+    index. The value (time booked) and effort (estimate) are in
+    minutes.'''
+    __slots__ = ('workpackage', 'value', 'effort', 'children', 'activities')
+    
+    def __init__(self, workpackage, value=0, activities=None):
         self.workpackage = workpackage
+        self.value = value
+        self.effort = 0
+        self.children = None
+        self.activities = activities
     
     def get_name(self):
         return '_self' if self.workpackage is None else self.workpackage.name
+    
+    def add_child(self, node):
+        if self.children is None:
+            self.children = [ node ]
+        else:
+            self.children.append(node)
+    
+    def get_node(self, pathstr):
+        n = self
+        for name in pathstr.split('.'):
+            n = next((c for c in n.children or () if c.get_name() == name), None)
+            if n is None:
+                return None
+        return n
+    
+    def dump(self, options, indent=''):
+        self.dump_node(options, indent)
+        if self.children is not None:
+            indent += options['indent']
+            for c in self.children:
+                c.dump(options, indent)
 
     def dump_node(self, options, indent):
         desc = None if self.workpackage is None else self.workpackage.description
         adorneddesc = '' if desc is None else ('; ' + desc)
-        output('{0:s}{1:7.2f} : {2:s}{3:s}'
-               .format(indent, self.value, self.get_name(), adorneddesc))
+        
+        if 'plan' in options:
+            used = '  ---' if self.effort == 0 else '{0:4.0f}%'.format(100 * self.value / self.effort)
+            weeks = options.get('weeks', 0)
+            rate = '    ---' if weeks == 0 else '{0:7.2f}'.format(hours(self.value) / weeks)
+            output('{0:s}{1:7.2f} {2:7.2f} {3:7.2f} {4:s} {5:s} : {6:s}{7:s}'
+                   .format(indent, hours(self.effort), hours(self.value),
+                           hours(self.effort - self.value), used, rate, self.get_name(), adorneddesc))
+        else:
+            output('{0:s}{1:7.2f} : {2:s}{3:s}'
+                   .format(indent, hours(self.value), self.get_name(), adorneddesc))
         
         if 'activities' in options:
             dump_activities(self.activities, '          ' + indent, options)
  
 class WorkPackage(Node):
+    '''A work package. Its activities are kept in the order they are
+    attached in, which is usually chronological already; whether it
+    is gets noted along the way. They are only put in order when the
+    activities attribute is used; sums over them use _activities.'''
     def __init__(self, name, desc=None, effort=0):
         Node.__init__(self)
         self.name = name
         self.description = desc
         self.effort = int(effort)
+        self._ordered = True
+        self._last_date = None
+    
+    @property
+    def activities(self):
+        '''The activities in chronological order, the ones of the same
+        day in the order they were attached in.'''
+        self.order_activities()
+        return self._activities
+    
+    @activities.setter
+    def activities(self, activities):
+        self._activities = activities
+    
+    def add_activity(self, activity, dt):
+        '''Append an activity of date dt (None if not known yet).'''
+        if self._ordered:
+            if dt is None or (self._last_date is not None and dt < self._last_date):
+                self._ordered = False
+            else:
+                self._last_date = dt
+        
+        if self._activities is None:
+            self._activities = [ activity ]
+        else:
+            self._activities.append(activity)
+    
+    def order_activities(self):
+        if not self._ordered:
+            if self._activities:
+                # Activities come in sorted runs, typically one per file,
+                # which the sort merges.
+                self._activities.sort(key=lambda a: a.day().date)
+                self._last_date = self._activities[-1].day().date
+            self._ordered = True
+    
+    def place_activity(self, activity):
+        '''Move an activity just attached to its place in chronological
+        order.'''
+        self._activities.remove(activity)
+        self.order_activities()
+        bisect.insort_right(self._activities, activity, key=lambda a: a.day().date)
+        self._last_date = self._activities[-1].day().date
     
     def create_node(self, name):
         return WorkPackage(name)
@@ -238,43 +691,145 @@ class WorkPackage(Node):
     def get_name(self):
         return self.name
     
+    def get_path(self):
+        '''The dotted path of this work package from the root.'''
+        names = []
+        wp = self
+        while wp._parent is not None:
+            names.append(wp.name)
+            wp = wp._parent()
+        return '.'.join(reversed(names))
+    
     def calc_effort(self):
-        e = self.effort
-        for s in self._children:
-            e += s.calc_effort()
+        '''Return the effort estimate of this work package and all its
+        sub-packages.'''
+        e = self.effort or 0
+        if self._children is not None:
+            for s in self._children:
+                e += s.calc_effort()
         return e
     
-    def calc_activity(self, dayfilter):
+    def sum_activity(self, dayfilter, collect=None):
+        '''Return the activity time of the days passing the filter and
+        the effort estimate of this work package and all its
+        sub-packages. The activities counted are appended to the
+        collect list, if given.'''
+        totals = 0
+        effort = 0
+        stack = [ self ]
+        
+        while len(stack) > 0:
+            wp = stack.pop()
+            effort += wp.effort or 0
+            if wp._activities is not None:
+                for a in wp._activities:
+                    if dayfilter.passes(a.day()):
+                        totals += a.duration
+                        if collect is not None:
+                            collect.append(a)
+            if wp._children is not None:
+                stack.extend(wp._children)
+        
+        return totals, effort
+    
+    def rank_activity(self, dayfilter, toplist, subtrees=False, path=''):
+        '''Offer all sub-packages with time on the days passing the
+        filter to the TopList as (path, work package) items. They are
+        ranked by the time booked directly on them or, if subtrees is
+        True, on them and their sub-packages. Returns the subtree
+        time of this work package.'''
+        own = 0
+        if self._activities is not None:
+            for a in self._activities:
+                if dayfilter.passes(a.day()):
+                    own += a.duration
+        
+        totals = own
+        if self._children is not None:
+            for c in self._children:
+                cpath = c.name if path == '' else path + '.' + c.name
+                totals += c.rank_activity(dayfilter, toplist, subtrees, cpath)
+        
+        value = totals if subtrees else own
+        if path != '' and value > 0:
+            toplist.offer(value, (path, self))
+        
+        return totals
+    
+    def calc_activity(self, dayfilter, depth=None, min_value=0, activities=True, plan=False):
+        '''Calculate the activity time of the days passing the filter
+        as a tree of ValueNodes, along with the effort estimates.
+        Sub-packages with no time, or less than min_value minutes, get
+        no node of their own (unless plan is True and they have an
+        estimate), and neither do the ones more than depth levels below
+        this one; their time and activities count as this package's
+        own. If activities is False the nodes do not list the
+        activities.'''
+        if depth == 0:
+            acts = [] if activities else None
+            totals, effort = self.sum_activity(dayfilter, acts)
+            if acts:
+                acts.sort(key=lambda a: a.day().date)
+            res = ValueNode(self, totals, acts or None)
+            res.effort = effort
+            return res
+        
         res = ValueNode(self)
-        totals = 0.0
+        effort = self.effort or 0
+        totals = 0
+        own = 0
+        acts = [] if activities else None
+        booked = self.activities if activities else self._activities
         
-        if self.activities is not None:
-            for a in self.activities:
+        if booked is not None:
+            for a in booked:
                 if dayfilter.passes(a.day()):
                     totals += a.duration
-                    a.attach_to(res)
-
+                    own += 1
+                    if activities:
+                        acts.append(a)
+        
+        subdepth = None if depth is None else depth - 1
+        children = []
+        folded = False
+        
         if self._children is not None:
             for s in self._children:
-                c = s.calc_activity(dayfilter)
-                if c.value != 0.0:
+                c = s.calc_activity(dayfilter, subdepth, min_value, activities, plan)
+                effort += c.effort
+                if (c.value != 0 and c.value >= min_value) or (plan and c.effort != 0):
                     # Only attach children with actual effort to
                     # keep the result pruned nicely
-                    if res.activities:
-                        # wp 'self' has both activities on itself and
-                        # on sub-wps. To make the activities on the wp
-                        # itself more easily visible, we insert a dummy
-                        # 'self' child here and move the activities
-                        # in question to that one.
-                        selfres = ValueNode(None, totals)
-                        res.add_child(selfres)
-                        for act in res.activities:
-                            act.attach_to(selfres)
-                        res.activities = []
+                    children.append(c)
+                elif c.value != 0:
+                    # A pruned child has no children of its own, so
+                    # its activities are those of its whole subtree.
                     totals += c.value
-                    res.add_child(c)
+                    own += 1
+                    if activities:
+                        acts.extend(c.activities)
+                        folded = True
+        
+        if folded:
+            acts.sort(key=lambda a: a.day().date)
+        
+        if (own > 0 or (plan and self.effort)) and len(children) > 0:
+            # wp 'self' has both activities (or in the plan, an
+            # estimate) on itself and on sub-wps. To make the ones on
+            # the wp itself more easily visible, we insert a dummy
+            # 'self' child here holding those activities.
+            selfres = ValueNode(None, totals, acts or None)
+            selfres.effort = self.effort or 0
+            res.add_child(selfres)
+            acts = None
+        
+        for c in children:
+            totals += c.value
+            res.add_child(c)
         
         res.value = totals
+        res.effort = effort
+        res.activities = acts if acts else None
             
         return res
 
@@ -289,15 +844,27 @@ class Activity:
     def __init__(self, duration, description):
         self.day = None
         self.workpackage = None
-        self.duration = float(duration)
+        self.duration = int(duration)
         self.description = description
     
+    @property
+    def description(self):
+        '''The description, None if there is none. It may be set to a
+        text reference, which is read from its file when needed.'''
+        return resolve_text(self._description)
+    
+    @description.setter
+    def description(self, description):
+        self._description = description
+    
     def attach_to(self, node):
         '''Attaches ourselves to the given node. If the node is a
         WorkPackage or a Day, a weak-ref to the parent node is
         set.'''
         if isinstance(node, WorkPackage):
             self.workpackage = weakref.ref(node)
+            node.add_activity(self, None if self.day is None else self.day().date)
+            return
         elif isinstance(node, Day):
             self.day = weakref.ref(node)
         
@@ -306,47 +873,10 @@ class Activity:
         else:
             node.activities.append(self)
 
-def add_value(original, newVal, newDesc):
-    if isinstance(original, tuple):
-        v, d = original
-    else:
-        v = original
-        d = None
-
-    v += newVal
-    
-    if newDesc is not None:
-        d = newDesc if d is None else d + '; ' + newDesc        
-    
-    if d is not None:
-        return (v, d)
-    else:
-        return v
-
-def set_value(original, val, comment=None):
-    if comment is not None:
-        return (val, comment)
-    else:
-        if isinstance(original, tuple):
-            return (val, original[1])
-        else:
-            return val
-
-def get_value(value):
-    if isinstance(value, tuple):
-        return value[0]
-    else:
-        return value
-
-def get_desc(value):
-    if isinstance(value, tuple):
-        return value[1]
-    else:
-        return None
-
 class Day:
     '''A Day object represents a day of work. It has a date,
-    hour information and comment information attached to it.'''
+    hour information and comment information attached to it.
+    All times and durations are integer numbers of minutes.'''
     def __init__(self, dt):
         if isinstance(dt, str):
             self.date = make_date(dt)
@@ -358,13 +888,24 @@ class Day:
         self.directives = None
         self.start = None
         self.stop = None
-        self.off = 0.0
-        self.sick = 0.0
-        self.leave = 0.0
-        self.required = 0.0 if is_weekend(self.date) else 8.0
+        self.off = 0
+        self.off_comment = None
+        self.sick = 0
+        self.sick_comment = None
+        self.sick_all_day = False
+        self.leave = 0
+        self.leave_comment = None
+        self.leave_all_day = False
+        self.required = 0 if is_weekend(self.date) else 480
         self.phol = None
-        self.comments = None
+        self._comments = None
         self.activities = None
+    
+    @property
+    def comments(self):
+        if self._comments is None:
+            return None
+        return [ resolve_text(c) for c in self._comments ]
         
     def add_directive(self, d):
         if self.directives is None:
@@ -373,29 +914,59 @@ class Day:
             self.directives.append(d)
         
     def add_comment(self, comment):
+        '''Add a comment: a string or a text reference.'''
         if comment is not None:
-            if self.comments is None:
-                self.comments = [ comment ]
+            if self._comments is None:
+                self._comments = [ comment ]
             else:
-                self.comments.append(comment)
+                self._comments.append(comment)
 
     def add_off(self, off, comment=None):
-        self.off = add_value(self.off, off, comment)
+        self.off += off
+        self.off_comment = join_comments(self.off_comment, comment)
 
     def set_phol(self, comment):
         self.phol = 'public holiday' if comment is None else comment 
 
-    def add_leave(self, leave, comment=None):
-        if isinstance(leave, bool):
-            self.leave = set_value(self.leave, leave, comment)
+    def add_leave(self, leave=None, comment=None):
+        '''Add leave time; None means the whole day, in which case
+        the comment replaces any earlier one.'''
+        if leave is None:
+            self.leave_all_day = True
+            if comment is not None:
+                self.leave_comment = comment
         else:
-            self.leave = add_value(self.leave, leave, comment)
+            self.leave += leave
+            self.leave_comment = join_comments(self.leave_comment, comment)
 
-    def add_sick(self, sick, comment=None):
-        if isinstance(sick, bool):
-            self.sick = set_value(self.sick, sick, comment)
+    def add_sick(self, sick=None, comment=None):
+        '''Add sick time; None means the whole day, in which case
+        the comment replaces any earlier one.'''
+        if sick is None:
+            self.sick_all_day = True
+            if comment is not None:
+                self.sick_comment = comment
         else:
-            self.sick = add_value(self.sick, sick, comment)
+            self.sick += sick
+            self.sick_comment = join_comments(self.sick_comment, comment)
+
+    def clear_leave_and_sick(self):
+        self.leave = self.sick = 0
+        self.leave_comment = self.sick_comment = None
+        self.leave_all_day = self.sick_all_day = False
+
+    def tidy_up(self, must_hours):
+        '''Set the required time from the must hours in effect and
+        settle leave and sick time for public holidays and whole days.'''
+        self.required = must_hours[self.date.weekday()]
+        
+        if self.phol is not None:
+            self.clear_leave_and_sick()
+        
+        if self.leave_all_day:
+            self.leave = self.required
+        if self.sick_all_day:
+            self.sick = self.required
 
     def set_hours(self, start, stop):
         if self.start is not None or self.stop is not None:
@@ -405,47 +976,98 @@ class Day:
         return True
     
     def calc_activity(self):
-        totals = 0.0
+        totals = 0
         if self.activities is not None:
             for a in self.activities:
                 totals += a.duration
         return totals
         
     def calc_have(self):
-        return self.calc_worked() + get_value(self.sick) + get_value(self.leave)
+        return self.calc_worked() + self.sick + self.leave
 
     def calc_worked(self):
-        at_work = 0.0 if self.start is None or self.stop is None else self.stop - self.start
-        return at_work - get_value(self.off)
+        at_work = 0 if self.start is None or self.stop is None else self.stop - self.start
+        return at_work - self.off
     
     def calc_required(self):
-        return 0.0 if self.phol else self.required
+        return 0 if self.phol else self.required
 
     def calc_balance(self):
         return self.calc_have() - self.calc_required()
     
     def is_workday(self):
-        return self.required != 0.0
+        return self.required != 0
                     
-    def dump(self, options):
-        worked = self.calc_worked()
-        cmnt = ''
+    def tally_row(self):
+        cmnt = None
         
-        for s in self.phol, get_desc(self.leave), get_desc(self.sick), get_desc(self.off):
+        for s in self.phol, self.leave_comment, self.sick_comment, self.off_comment:
             if s is not None:
-                cmnt = cmnt + '; ' + s
-            
-        output(self.date.strftime('%Y-%m-%d %a: ') + \
-              format_floatval(worked) + ' ' +\
-              format_floatval(get_value(self.leave)) + ' ' +\
-              format_floatval(get_value(self.sick)) + ' ' +\
-              format_floatval(self.calc_balance()) + cmnt[1:])
+                cmnt = join_comments(cmnt, s)
+        
+        return TallyRow('day', format_date(self.date), self.calc_worked(), self.leave,
+                        self.sick, self.calc_balance(), cmnt, self)
+
+class TallyRow:
+    '''One line of the time at work overview: a day, a missing day
+    or the totals of a period. All values are minutes.'''
+    def __init__(self, kind, label, worked=0, leave=0, sick=0, balance=0, comment=None, day=None):
+        self.kind = kind
+        self.label = label
+        self.worked = worked
+        self.leave = leave
+        self.sick = sick
+        self.balance = balance
+        self.comment = comment
+        self.day = day
+        self.rolling = None
+        self.segment = None
+    
+    def format(self):
+        if self.kind == 'missing':
+            return 'missing weekday record for ' + self.label
+        
+        if self.rolling is None:
+            rolling = ''
+        else:
+            rolling = ' ' + format_floatval(self.rolling[0]) + ' ' + format_floatval(self.rolling[1])
+        
+        cmnt = '' if self.comment is None else ' ' + self.comment
+        return '{0:>14s}: '.format(self.label) +\
+              format_floatval(self.worked) + ' ' +\
+              format_floatval(self.leave) + ' ' +\
+              format_floatval(self.sick) + ' ' +\
+              format_floatval(self.balance) + rolling + cmnt
+    
+    def dump(self, options):
+        output(self.format())
         
-        if 'comments' in options and self.comments is not None:
+        if 'comments' in options and self.day is not None and self.day.comments is not None:
             prefix = ' ' * 14 + '; '
-            for cmnt in self.comments:
+            for cmnt in self.day.comments:
                 output(prefix + cmnt)
 
+class DayProblem:
+    '''A problem found by the day check. For kind 'allocation' the
+    amount is the allocated time and the reference the time worked,
+    for the kinds 'sick', 'leave' and 'leave and sick' the amount
+    is the time taken and the reference the required time.'''
+    def __init__(self, day, kind, amount, reference):
+        self.day = day
+        self.kind = kind
+        self.amount = amount
+        self.reference = reference
+    
+    def format(self):
+        dt_str = format_date(self.day.date)
+        
+        if self.kind == 'allocation':
+            return '{0:s}: worked {1:5.2f}, allocated {2:5.2f}, delta {3:5.2f}'\
+                   .format(dt_str, hours(self.reference), hours(self.amount),
+                           hours(self.amount - self.reference))
+        else:
+            return dt_str + ': more ' + self.kind + ' time (' + format_hours(self.amount) +\
+                   ') taken than required working time (' + format_hours(self.reference) + ').'
         
 class Directive:
     def __init__(self):
@@ -470,17 +1092,232 @@ class Directive:
         self.reset = True
         return self
 
+class Message:
+    '''A single diagnostic raised while reading the input. The import
+    chain is a tuple of (file, line) pairs shared by all messages
+    raised by the same reader.'''
+    def __init__(self, file, line, kind, code, text, chain=()):
+        self.file = file
+        self.line = line
+        self.kind = kind
+        self.code = code
+        self.text = text
+        self.chain = chain
+    
+    def key(self):
+        return (self.file, self.line, self.kind, self.code, self.text)
+    
+    def as_dict(self):
+        return { 'file':self.file, 'line':self.line, 'kind':self.kind,
+                 'code':self.code, 'text':self.text,
+                 'imported-from':[ { 'file':f, 'line':l } for f, l in self.chain ] }
+    
+    def dump(self):
+        output(self.file + ':' + str(self.line) + ': ' + self.kind + ' : ' + self.text)
+        for f, l in self.chain:
+            output(f + ':' + str(l) + ': imported here')
+
+class Diagnostics:
+    '''Collects the messages raised while reading. Identical messages
+    (same code, location and text) are only kept once. Each file gets
+    at most 'limit' messages; a limit of 0 means no limit. Messages
+    beyond the limit are only counted (as errors or warnings, and as
+    suppressed).'''
+    def __init__(self, limit=100, fmt='text'):
+        self.limit = limit
+        self.format = fmt
+        self.messages = []
+        self.errors = 0
+        self.warnings = 0
+        self.suppressed = 0
+        self._seen = set()
+        self._per_file = {}
+        self._flushed = 0
+    
+    def add(self, msg):
+        '''Record the given message. Returns False if the message's
+        file has reached its message limit, so that it is only
+        counted, True otherwise.'''
+        key = msg.key()
+        if key in self._seen:
+            return True
+        self._seen.add(key)
+        
+        count = self._per_file.get(msg.file, 0) + 1
+        self._per_file[msg.file] = count
+        
+        if msg.kind == 'ERROR':
+            self.errors += 1
+        elif msg.kind == 'WARNING':
+            self.warnings += 1
+        
+        if self.limit != 0 and count > self.limit:
+            self.suppressed += 1
+            return False
+        self.messages.append(msg)
+        return True
+    
+    def summary(self):
+        msg = ''
+        if self.errors > 0:
+            msg += ", " + plural(self.errors, "error")
+        if self.warnings > 0:
+            msg += ", " + plural(self.warnings, "warning")
+        if self.suppressed > 0:
+            msg += " (" + plural(self.suppressed, "message") + " not shown)"
+        return msg[2:]
+    
+    def flush(self):
+        '''Output all messages recorded since the last flush, followed
+        by the overall error and warning counts. As JSON they go to
+        standard error, apart from the reports.'''
+        pending = self.messages[self._flushed:]
+        self._flushed = len(self.messages)
+        
+        if self.format == 'json':
+            output(json.dumps({ 'errors':self.errors, 'warnings':self.warnings,
+                                'suppressed':self.suppressed, 'messages':[ m.as_dict() for m in pending ] }, indent=1), sys.stderr)
+        else:
+            for m in pending:
+                m.dump()
+            summary = self.summary()
+            if len(summary) > 0:
+                output(summary + '.')
+
+class DayIndex:
+    '''The days of a universe in chronological order, together with
+    their ordinals and their ISO week (YYYYWW) and month (YYYYMM)
+    period keys. The year in both keys is the ISO year.'''
+    def __init__(self, days):
+        self.days = sorted(days, key = lambda day: day.date)
+        self.ordinals = []
+        self.weeks = []
+        self.months = []
+        
+        for day in self.days:
+            year, week = day.date.isocalendar()[0:2]
+            self.ordinals.append(day.date.toordinal())
+            self.weeks.append(year * 100 + week)
+            self.months.append(year * 100 + day.date.month)
+    
+    def insert(self, day):
+        '''Insert a day not in the index yet.'''
+        ordinal = day.date.toordinal()
+        i = bisect.bisect_left(self.ordinals, ordinal)
+        year, week = day.date.isocalendar()[0:2]
+        self.days.insert(i, day)
+        self.ordinals.insert(i, ordinal)
+        self.weeks.insert(i, year * 100 + week)
+        self.months.insert(i, year * 100 + day.date.month)
+    
+    def remove(self, day):
+        i = bisect.bisect_left(self.ordinals, day.date.toordinal())
+        for keys in self.days, self.ordinals, self.weeks, self.months:
+            del keys[i]
+    
+    def between(self, first, last):
+        '''The days from ordinal first to ordinal last.'''
+        return self.days[bisect.bisect_left(self.ordinals, first):bisect.bisect_right(self.ordinals, last)]
+
+class Identity:
+    '''The person day records belong to, as set by the 'identity'
+    instruction. Each identity has its own set of days. Day records
+    read before any identity instruction belong to the anonymous
+    identity (name None).'''
+    def __init__(self, name, fullname=None):
+        self.name = name
+        self.fullname = fullname
+        self.days = {}
+        self.day_index = DayIndex([])
+        self.musthours = None
+    
+    def label(self):
+        name = 'anonymous' if self.name is None else self.name
+        return name if self.fullname is None else name + ' (' + self.fullname + ')'
+    
+    def get_chrono_days(self):
+        return self.day_index.days
+    
+    def tidy_up(self, default_musthours):
+        must_hours = default_musthours if self.musthours is None else self.musthours
+        self.day_index = DayIndex(self.days.values())
+            
+        for day in self.get_chrono_days():
+            if day.musthours is not None:
+                must_hours = day.musthours
+            
+            day.tidy_up(must_hours)
+
+def words(text):
+    '''Split a text into lower case search words. Words joined by '-'
+    or '.' (e.g. ticket numbers) are taken both as a whole and in
+    parts.'''
+    result = []
+    for word in re.findall('\\w+(?:[-.]\\w+)*', text.lower()):
+        result.append(word)
+        if '-' in word or '.' in word:
+            result.extend(re.split('[-.]', word))
+    return result
+
+class SearchIndex:
+    '''An inverted index from search words to the activities whose
+    descriptions contain them and to the day comments containing
+    them. Entries are Activity objects or (day, comment) pairs.'''
+    def __init__(self, universe):
+        self.entries = []
+        self._postings = {}
+        
+        stack = [ universe.workpackage_root ]
+        while len(stack) > 0:
+            wp = stack.pop()
+            for a in wp.activities or ():
+                if a.description is not None:
+                    self._add(a.description, a)
+            stack.extend(reversed(wp._children or ()))
+        
+        for identity in universe.identities.values():
+            for day in identity.get_chrono_days():
+                for comment in day.comments or ():
+                    self._add(comment, (day, comment))
+    
+    def _add(self, text, entry):
+        n = len(self.entries)
+        self.entries.append(entry)
+        for word in set(words(text)):
+            postings = self._postings.get(word)
+            if postings is None:
+                self._postings[word] = [ n ]
+            else:
+                postings.append(n)
+    
+    def search(self, terms):
+        '''Return the entries containing all words of the given terms,
+        in index order.'''
+        query = set(words(terms))
+        if len(query) == 0:
+            return []
+        
+        postings = sorted((self._postings.get(w, ()) for w in query), key=len)
+        found = set(postings[0])
+        for p in postings[1:]:
+            found.intersection_update(p)
+            if len(found) == 0:
+                break
+        
+        return [ self.entries[n] for n in sorted(found) ]
+
 class Universe:
     def __init__(self):
-        self.days = {}
+        self.identities = {}
+        self.anonymous = self.get_identity(None)
         self.workpackage_root = WorkPackage("ALL")
         self.dump_options = { 'indent':'    ' }
         self.inputfiles = []
         self.inputfileset = set()
         self.currentday = None
         self.musthours = None
-        self.errors = 0
-        self.warnings = 0
+        self.diagnostics = Diagnostics()
+        self._search_index = None
         
     def remember(self, file):
         if file in self.inputfileset:
@@ -495,8 +1332,32 @@ class Universe:
     def get_workpackage(self, pathname):
         return self.workpackage_root.get_node(pathname)
         
+    def get_identity(self, name, fullname=None):
+        '''Return the identity of the given name, creating it if
+        necessary.'''
+        if name in self.identities:
+            identity = self.identities[name]
+            if fullname is not None:
+                identity.fullname = fullname
+        else:
+            identity = Identity(name, fullname)
+            self.identities[name] = identity
+        return identity
+    
+    def get_search_index(self):
+        if self._search_index is None:
+            self._search_index = SearchIndex(self)
+        return self._search_index
+    
+    def get_people(self):
+        '''All identities with day records, in order of appearance.'''
+        return [ i for i in self.identities.values() if len(i.days) > 0 ]
+    
+    def is_team(self):
+        return any(i.name is not None for i in self.get_people())
+    
     def get_chrono_days(self):
-        return sorted(self.days.values(), key = lambda day: day.date)
+        return self.anonymous.get_chrono_days()
     
     def bill_of_materials(self, abspaths=False):
         for file in self.inputfiles:
@@ -511,112 +1372,416 @@ class Universe:
     def tidy_up(self):
         self.currentday = None
 
+        self._search_index = None
+        
         if self.musthours is None:
-            self.musthours = [8.0] * 5 + [0.0] * 2     
-   
-        must_hours = self.musthours
-            
-        for day in self.get_chrono_days():
-            if day.musthours is not None:
-                must_hours = day.musthours
-            
-            day.required = must_hours[day.date.weekday()]
-
-            if day.phol is not None:
-                day.leave = 0.0
-                day.sick = 0.0
-            
-            leave = get_value(day.leave)
-            sick = get_value(day.sick)
-            
-            if isinstance(leave, bool) and leave == True:
-                day.leave = set_value(day.leave, day.required)
-            if isinstance(sick, bool) and sick == True:
-                day.sick = set_value(day.sick, day.required)
+            self.musthours = [480] * 5 + [0] * 2
         
-        self.workpackage_root.tidy_up()
+        for identity in self.identities.values():
+            identity.tidy_up(self.musthours)
         
+
 class WorkPackageLineBookmark:
     def __init__(self, workpackage, indent, parent=None):
         self.indent = indent
         self.workpackage = workpackage
         self.parent = parent
 
+_decompressors = { '.gz':gzip.open, '.bz2':bz2.open, '.xz':lzma.open, '.lzma':lzma.open }
+
+def load_file(path, binary=False, newline=None):
+    '''The default input loader: opens the file of the given path;
+    '-' means standard input. Files ending in .gz, .bz2, .xz or .lzma
+    are decompressed on the fly while they are being read. Binary
+    files (archives) are opened with binary set; newline is passed on
+    to text files (tables are read with '', as the csv module wants).'''
+    if path == '-':
+        return sys.stdin.buffer if binary else sys.stdin
+    opener = _decompressors.get(os.path.splitext(path)[1])
+    if binary:
+        return (opener or open)(path, 'rb')
+    if opener is not None:
+        return opener(path, 'rt', newline=newline)
+    return open(path, newline=newline)
+
+_table_delimiters = { '.csv':',', '.tsv':'\t' }
+
+def table_delimiter(path):
+    '''Return the column delimiter if the path names a CSV or TSV file
+    (possibly compressed), None otherwise.'''
+    root, ext = os.path.splitext(path)
+    if ext in _decompressors:
+        ext = os.path.splitext(root)[1]
+    return _table_delimiters.get(ext.lower())
+
+# A line of a memory mapped input: the part before any comment and the rest.
+_mapped_line = re.compile(rb'([^\n#]*)[^\n]*\n?')
+
+# The files text references point into, by id: [path, size, mtime,
+# encoding, open file or None], and the ids by (path, encoding). Only
+# the latest version of a file is kept; once it has changed, the
+# references into the older version cannot be resolved any more.
+_text_files = {}
+_text_file_ids = {}
+_text_file_count = itertools.count()
+_text_lock = threading.Lock()
+
+def text_file_id(path, encoding):
+    '''Return the id of the file of the given path for text references,
+    registering it if necessary. A file that has changed gets a new
+    id, and the one of its earlier version is dropped.'''
+    st = os.stat(path)
+    key = (os.path.abspath(path), encoding)
+    with _text_lock:
+        file_id = _text_file_ids.get(key)
+        entry = None if file_id is None else _text_files[file_id]
+        if entry is None or entry[1] != st.st_size or entry[2] != st.st_mtime_ns:
+            if entry is not None:
+                del _text_files[file_id]
+                if entry[4] is not None:
+                    entry[4].close()
+            file_id = _text_file_ids[key] = next(_text_file_count)
+            _text_files[file_id] = [key[0], st.st_size, st.st_mtime_ns, encoding, None]
+    return file_id
+
+def close_text_files():
+    '''Close the files opened to resolve text references. They are
+    opened again when needed.'''
+    with _text_lock:
+        for entry in _text_files.values():
+            if entry[4] is not None:
+                entry[4].close()
+                entry[4] = None
+
+def text_ref(file_id, offset, length):
+    '''A text reference: one int standing for the length bytes at the
+    byte offset in a file, which is less memory than most strings.'''
+    return (file_id << 56) | (offset << 16) | length
+
+def resolve_text(text):
+    '''Return the text a text reference stands for, reading it from its
+    file. Strings and None are returned as they are. Raises ValueError
+    if the file has changed since it was read.'''
+    if not isinstance(text, int):
+        return text
+    
+    with _text_lock:
+        entry = _text_files.get(text >> 56)
+        if entry is None:
+            raise ValueError('the file of a text reference has changed since it was read')
+        path, size, mtime, encoding = entry[:4]
+        if entry[4] is None:
+            entry[4] = open(path, 'rb')
+        f = entry[4]
+        st = os.fstat(f.fileno())
+        if st.st_size != size or st.st_mtime_ns != mtime:
+            raise ValueError('file ' + path + ' has changed since it was read')
+        f.seek((text >> 16) & ((1 << 40) - 1))
+        data = f.read(text & 0xffff)
+    return data.decode(encoding)
+
 class Reader:
-    def __init__(self, uni, parent=None):
+    '''Reads input files into a universe. Inputs, including imported
+    ones, are obtained through the loader: a function taking a path and
+    returning a string, a file-like object or an iterable of lines, or
+    raising IOError; for archives (see is_archive()) it has to return
+    bytes or a binary file. A non-verbose reader does not print anything; its
+    messages are left in the universe's diagnostics. With lazy_text,
+    activity descriptions and day comments of files read through a
+    memory map are kept as text references (see text_ref()) rather
+    than strings.'''
+    def __init__(self, uni, parent=None, loader=None, verbose=True, lazy_text=False):
         self._universe = uni
         self._parent = parent
+        self._identity = uni.anonymous if parent is None else parent._identity
+        self._root_bookmark = WorkPackageLineBookmark(uni.workpackage_root, -1)
+        
+        self._line_end = None
+        
+        if parent is None:
+            self._loader = load_file if loader is None else loader
+            self._verbose = verbose
+            self._lazy_text = lazy_text
+        else:
+            self._loader = parent._loader
+            self._verbose = parent._verbose
+            self._lazy_text = parent._lazy_text
 
-    def read(self, inputfile):
+    def read(self, inputfile, content=None):
+        '''Read the given input. Unless its content (a string, a
+        file-like object or an iterable of lines) is given it is
+        obtained through the loader.'''
+        if not self._start(inputfile):
+            return
+        
+        failure = self._read_input(inputfile, content)
+        if failure is not None:
+            self._open_failed(inputfile, failure)
+        
+        if self._parent is None: # top level read finished
+            self._finish()
+    
+    def _start(self, inputfile):
+        '''Get ready to read the given input. Returns False if it is
+        imported in a loop.'''
         self._absinputfile = os.path.abspath(inputfile)
         self._already_read_before = self._universe.remember(self._absinputfile)
         self._inputfile = inputfile
         self._linecount = 0
+        self._chain = self._import_chain()
+        
+        if self._parent is None:
+            self._identity = self._universe.anonymous
         self._reset_workpackage_stack()
         
         if self._have_import_loop():
-            self._parent._msg('file ' + inputfile + ' already processed', 'WARNING')
-            return
+            self._parent._msg('file ' + inputfile + ' already processed', 'WARNING', 'import-loop')
+            return False
+        return True
+    
+    def _read_input(self, inputfile, content):
+        '''Read the input. Returns the message if it cannot be opened.
+        Errors while reading, like a corrupt or truncated compressed
+        file, are reported at the last line read.'''
+        try:
+            archive = is_archive(inputfile) and (content is None or isinstance(content, bytes))
+            delimiter = table_delimiter(inputfile)
+            if archive:
+                f = self._open(inputfile, content, True)
+            elif delimiter is not None:
+                f = self._open(inputfile, content, newline='')
+            elif content is None and self._loader is load_file:
+                f = self._map(inputfile)
+                if f is None:
+                    f = self._open(inputfile, content)
+            else:
+                f = self._open(inputfile, content)
+        except IOError as e:
+            return 'failed to open file; ' + str(e)
         
         try:
-            with open(inputfile) as f:
+            with f as lines:
                 bom_indent = self._universe.dump_options['indent'] * self._import_level()
                 self._universe.add_file(bom_indent + inputfile)
-                self._read_file(f)
-            
-        except IOError as e:
-            msg = 'failed to open file; ' + str(e)
-            if self._parent is None:
-                output(msg)
-            else:
-                self._parent._msg(msg)
+                if archive:
+                    self._read_archive(lines)
+                elif delimiter is not None:
+                    self._read_table(lines, delimiter)
+                elif isinstance(lines, mmap.mmap):
+                    self._read_mapped(lines, self._mapped_encoding)
+                else:
+                    self._read_file(lines)
         
-        if self._parent is None: # top level read finished
-            self._universe.tidy_up()
-            msg = ''
-            if self._universe.errors > 0:
-                msg += ", " + plural(self._universe.errors, "error")
-            if self._universe.warnings > 0:
-                msg += ", " + plural(self._universe.warnings, "warning")
-            if len(msg) > 0:
-                output(msg[2:] + '.')
-
-    def _import_level(self):
-        reader, lev = self, 0
-        while reader._parent is not None:
+        except (EOFError, lzma.LZMAError, zlib.error, OSError, UnicodeDecodeError) as e:
+            self._msg('failed to read file; ' + str(e) + '.', code='read-failed')
+        
+        return None
+    
+    def _open_failed(self, inputfile, msg):
+        if self._parent is not None:
+            self._parent._msg(msg, code='open-failed')
+        elif self._verbose:
+            output(msg)
+        else:
+            self._universe.diagnostics.add(Message(inputfile, 0, 'ERROR', 'open-failed', msg))
+    
+    def _finish(self):
+        self._universe.tidy_up()
+        if self._verbose:
+            self._universe.diagnostics.flush()
+
+    def _open(self, inputfile, content, binary=False, newline=None):
+        '''Return a context manager giving the lines of the input, or
+        the binary file of an archive. Only inputs obtained from the
+        loader get closed.'''
+        if content is None:
+            if self._loader is load_file:
+                content = load_file(inputfile, binary, newline)
+            else:
+                content = self._loader(inputfile)
+            if hasattr(content, '__exit__') and content not in (sys.stdin, sys.stdin.buffer):
+                return content
+        
+        if isinstance(content, str):
+            return io.StringIO(content)
+        elif isinstance(content, bytes):
+            return io.BytesIO(content)
+        else:
+            return contextlib.nullcontext(content)
+
+    def _map(self, inputfile):
+        '''Memory map a plain input file if its text can be scanned as
+        bytes, i.e. in an encoding with single byte newlines and '#'
+        and without the carriage returns that text mode translates.
+        Returns None if not.'''
+        encoding = codecs.lookup(locale.getpreferredencoding(False)).name
+        if encoding not in ('utf-8', 'ascii', 'iso8859-1', 'cp1252') or inputfile == '-' or \
+                os.path.splitext(inputfile)[1] in _decompressors:
+            return None
+        
+        with open(inputfile, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        if mapped.find(b'\r') >= 0:
+            mapped.close()
+            return None
+        
+        self._mapped_encoding = encoding
+        return mapped
+
+    def _import_chain(self):
+        '''The (file, line) positions of the import lines that led to
+        this reader, innermost first.'''
+        chain = []
+        parent = self._parent
+        while parent is not None:
+            chain.append((parent._inputfile, parent._linecount))
+            parent = parent._parent
+        return tuple(chain)
+
+    def _import_level(self):
+        reader, lev = self, 0
+        while reader._parent is not None:
             reader, lev = reader._parent, lev + 1
         return lev
             
     def _read_file(self, f):
         for line in f:
             self._linecount += 1
-            line = re.sub(" *#.*", "", line).rstrip()
+            self._process_line(re.sub(" *#.*", "", line).rstrip())
+    
+    def _read_mapped(self, mapped, encoding):
+        '''Like _read_file(), scanning the bytes of a memory mapped file
+        for line ends and comments with one regular expression. Only the
+        part of a line before a comment gets copied and decoded; blank
+        lines are not copied at all.'''
+        size = len(mapped)
+        if self._lazy_text:
+            self._text_file = text_file_id(self._inputfile, encoding)
+        
+        for match in _mapped_line.finditer(mapped):
+            if match.start() == size:
+                break
+            self._linecount += 1
             
-            indent = len(line) - len(line.lstrip())
+            start, end = match.span(1)
+            line = b'' if start == end else match.group(1).rstrip()
             
-            if indent == 0:
+            if line == b'':
                 self._reset_workpackage_stack()
-                
-            if line == '':
-                self._reset_workpackage_stack()
-            elif self._in_workpackage_definition():
-                self._process_workpackage(line)
-            elif line.startswith('wp '):
-                self._process_workpackage(line[3:].strip())
-            elif line.startswith('work-package '):
-                self._process_workpackage(line[13:].strip())
+            elif self._lazy_text:
+                text = line.decode(encoding)
+                stripped = text.rstrip()
+                self._line_end = start + len(line) if len(stripped) == len(text) else None
+                self._process_line(stripped)
             else:
-                self._reset_workpackage_stack()
-                    
-                if line.startswith('- '):
-                    self._process_activity(line[2:].strip())
-                elif line.startswith('; '):
-                    self._process_comment(line[2:].strip())
-                elif line.startswith('import '):
-                    self._import_file(line[7:].strip())
-                elif line.strip() != '':
-                    self._process_instructions(line)
+                self._process_line(line.decode(encoding).rstrip())
+        
+        self._line_end = None
+    
+    def _text(self, text):
+        '''A description or comment ending the current line, as a text
+        reference if the line has been located in a file for that.'''
+        if self._line_end is None or text == '':
+            return text
+        
+        length = len(text) if text.isascii() else len(text.encode(self._mapped_encoding))
+        if length >= 1 << 16:
+            return text
+        return text_ref(self._text_file, self._line_end - length, length)
+    
+    def _process_line(self, line):
+        '''Process a line without its comment and trailing blanks.'''
+        indent = len(line) - len(line.lstrip())
+        
+        if indent == 0:
+            self._reset_workpackage_stack()
+            
+        if line == '':
+            self._reset_workpackage_stack()
+        elif self._in_workpackage_definition():
+            self._process_workpackage(line)
+        elif line.startswith('wp '):
+            self._process_workpackage(line[3:].strip())
+        elif line.startswith('work-package '):
+            self._process_workpackage(line[13:].strip())
+        else:
+            self._reset_workpackage_stack()
+                
+            if line.startswith('- '):
+                self._process_activity(line[2:].strip())
+            elif line.startswith('; '):
+                self._process_comment(self._text(line[2:].strip()))
+            elif line.startswith('import '):
+                self._import_file(line[7:].strip())
+            elif line.strip() != '':
+                self._process_instructions(line)
+    
+    #   date, start, stop, work package, duration, comment
+    def _read_table(self, f, delimiter):
+        '''Read CSV or TSV rows with the columns date, start, stop, work
+        package, duration and comment straight into days and activities.
+        A row adds an activity to its day. Start and stop give the day's
+        hours; later rows of the day may leave them empty or repeat them.
+        A row without a work package adds its comment to the day. An
+        optional header row starts with "date".'''
+        rows = csv.reader(f, delimiter=delimiter)
+        workpackages = {}
+        
+        for row in rows:
+            self._linecount = rows.line_num
+            
+            if len(row) == 0 or row[0].startswith('#'):
+                continue
+            if rows.line_num == 1 and row[0].strip().lower() == 'date':
+                continue
+            if len(row) > 6:
+                self._msg('too many columns (' + str(len(row)) + ').', code='table-columns')
+                continue
+            
+            datestring, start, stop, workpackage_name, duration, desc = \
+                [ cell.strip() for cell in row ] + [''] * (6 - len(row))
+            
+            try:
+                datestring = str(make_date(datestring))
+            except ValueError:
+                self._msg('bad date "' + datestring + '".', code='bad-date')
+                continue
+            
+            if start == '' and stop == '':
+                self._new_day([datestring])
+            elif not self._has_hours(datestring, make_time(start), make_time(stop)):
+                self._new_day([datestring, start, stop])
+            
+            if workpackage_name != '':
+                self._add_activity(workpackage_name, duration, desc if desc != '' else None, workpackages)
+            elif desc != '':
+                self._process_comment(desc)
+            elif duration != '':
+                self._msg('an activity must have a work package and a duration.', code='activity-args')
+    
+    def _has_hours(self, datestring, start, stop):
+        day = self._identity.days.get(datestring)
+        return day is not None and day.start is not None and day.start == start and day.stop == stop
+    
+    def _read_archive(self, f):
+        if self._redefining('archive'):
+            return
+        
+        try:
+            skipped = self._load_archive(f)
+        except ValueError as e:
+            self._msg('failed to load archive; ' + str(e) + '.', code='read-failed')
+            return
         
+        for datestring in skipped:
+            self._msg_day_redefined(datestring)
+    
+    def _load_archive(self, f):
+        return load_archive(f, self._universe)
+    
     def _have_import_loop(self):
         p = self._parent
         
@@ -627,37 +1792,37 @@ class Reader:
             
         return False
     
-    def _import_file(self, file):
-        sub_reader = Reader(self._universe, self)
-        
+    def _import_path(self, file):
         if os.path.isabs(file):
-            f = file
+            return file
         else:
             folder = os.path.dirname(self._inputfile)
-            f = os.path.join(folder, file)
-        
-        sub_reader.read(f)
+            return os.path.join(folder, file)
+    
+    def _import_file(self, file):
+        sub_reader = Reader(self._universe, self)
+        sub_reader.read(self._import_path(file))
 
     def _msg_redef(self, text):
-        self._msg('re-defining ' + text + ' (this file has already been read before)')
-        
-    def _msg(self, text, kind='ERROR'):
-        output(self._inputfile + ':' + str(self._linecount) + ': ' + kind + ' : ' + text)
-        parent = self._parent
-        
-        while parent is not None:
-            output(parent._inputfile + ':' + str(parent._linecount) + ': imported here')
-            parent = parent._parent
+        self._msg('re-defining ' + text + ' (this file has already been read before)', code='redefinition')
+    
+    def _redefining(self, text):
+        '''Report the re-definition if this file has been read before.
+        Returns True in that case.'''
+        if self._already_read_before:
+            self._msg_redef(text)
+        return self._already_read_before
         
-        if kind == 'ERROR':
-            self._universe.errors += 1
-        elif kind == 'WARNING':
-            self._universe.warnings += 1
-        else:
+    def _msg(self, text, kind='ERROR', code='error'):
+        if kind != 'ERROR' and kind != 'WARNING':
             output('*** Bad msg type ' + kind)
+            return
+        
+        msg = Message(self._inputfile, self._linecount, kind, code, text, self._chain)
+        self._universe.diagnostics.add(msg)
             
     def _reset_workpackage_stack(self):
-        self._workpackage_stack = WorkPackageLineBookmark(self._universe.workpackage_root, -1)
+        self._workpackage_stack = self._root_bookmark
         self._previous_indentation_prefix = ''
         
     def _in_workpackage_definition(self):
@@ -666,19 +1831,19 @@ class Reader:
     #   name.of.the.workpackage [params ...]; description
     def _process_workpackage(self, line):
         items = line.split(';', 1)
-        spec = items[0].strip().split(' ')
+        spec = tidy_whitespace(items[0]).split(' ')
         fullname = spec[0]
                 
         indentation_len = len(line) - len(line.lstrip())
         indentation_prefix = line[:indentation_len]
         
         if ' ' in indentation_prefix and '\t' in indentation_prefix:
-            self._msg('indentation contains both spaces and tabs')
+            self._msg('indentation contains both spaces and tabs', code='indent-mixed')
             return
         
         if not indentation_prefix.startswith(self._previous_indentation_prefix) \
             and not self._previous_indentation_prefix.startswith(indentation_prefix):
-            self._msg('work package indentation error')
+            self._msg('work package indentation error', code='indent-mismatch')
             return
         
         self._previous_indentation_prefix = indentation_prefix
@@ -689,7 +1854,11 @@ class Reader:
         wp = self._workpackage_stack.workpackage.get_node(fullname, create=True)
         
         if len(spec) > 1: # effort
-            wp.effort = make_time(spec[1])
+            effort = make_time(spec[1])
+            if effort is None:
+                self._msg('bad effort "' + spec[1] + '" for work package "' + fullname + '".', code='bad-time')
+            else:
+                wp.effort = effort
             
         if len(items) == 2: # description
             wp.description = items[1].strip()
@@ -700,30 +1869,47 @@ class Reader:
         comps = line.split(';', 1)
         args = tidy_whitespace(comps[0]).split(' ')
         if len(args) < 2:
-            self._msg('an activity must have a work package and a duration.')
-        elif self._already_read_before:
-            self._msg_redef('activity')
+            self._msg('an activity must have a work package and a duration.', code='activity-args')
         else:
-            workpackage_name = args[0]
-            duration = args[1]
             if len(comps) == 2:
-                desc = comps[1].strip()
+                desc = self._text(comps[1].strip())
             else:
                 desc = None
-
-            duration_float = make_time(duration)
-            wp = self._universe.get_workpackage(workpackage_name)
             
-            if wp is None:
-                self._msg('invalid activity work package "' + workpackage_name + '".')  
+            self._add_activity(args[0], args[1], desc)
+    
+    def _add_activity(self, workpackage_name, duration, desc, workpackages=None):
+        '''Add an activity to the current day. The optional dict
+        workpackages caches work package lookups by name.'''
+        if self._redefining('activity'):
+            return
+        
+        minutes = make_time(duration)
+        wp = self._lookup_workpackage(workpackage_name, workpackages)
+        
+        if wp is None:
+            self._msg_unknown_workpackage(workpackage_name)
 
-            if duration_float is None:
-                self._msg('invalid activity duration "' + duration + '".')
-            
-            if wp is not None and duration_float is not None:
-                activity = Activity(duration_float, desc)
-                activity.attach_to(wp)
-                activity.attach_to(self._universe.currentday)
+        if minutes is None:
+            self._msg('invalid activity duration "' + duration + '".', code='bad-duration')
+        
+        if wp is not None and minutes is not None:
+            self._attach_activity(wp, minutes, desc)
+    
+    def _msg_unknown_workpackage(self, workpackage_name):
+        self._msg('invalid activity work package "' + workpackage_name + '".', code='unknown-work-package')
+    
+    def _lookup_workpackage(self, workpackage_name, workpackages=None):
+        if workpackages is None:
+            return self._universe.get_workpackage(workpackage_name)
+        elif workpackage_name not in workpackages:
+            workpackages[workpackage_name] = self._universe.get_workpackage(workpackage_name)
+        return workpackages[workpackage_name]
+    
+    def _attach_activity(self, wp, minutes, desc):
+        activity = Activity(minutes, desc)
+        activity.attach_to(self._universe.currentday)
+        activity.attach_to(wp)
         
     def _process_comment(self, comment):
         self._universe.currentday.add_comment(comment)
@@ -759,44 +1945,52 @@ class Reader:
     def _new_day(self, args):
         largs = len(args)
         if largs != 1 and largs != 3:
-            self._msg('unexpected day argument list: "' + ' '.join(args) + '".')
+            self._msg('unexpected day argument list: "' + ' '.join(args) + '".', code='day-args')
             
         datestring = args[0]
-        
-        if datestring in self._universe.days:
-            self._universe.currentday = self._universe.days[datestring]
-        else:
-            self._universe.currentday = Day(datestring)
-            self._universe.days[datestring] = self._universe.currentday
+        self._set_current_day(datestring)
 
         if largs == 3:
             start = make_time(args[1])
             end = make_time(args[2])
 
             if start is None:
-                self._msg('bad start time argument "' + args[1] + '" in day spec.')
+                self._msg('bad start time argument "' + args[1] + '" in day spec.', code='bad-time')
             elif end is None:
-                self._msg('bad end time argument "' + args[2] + '" in day spec.')
-            elif self._already_read_before:
-                self._msg_redef('day')
-            elif not self._universe.currentday.set_hours(start, end): 
-                self._msg('day ' + str(self._universe.currentday.date) + ' redefined.')             
+                self._msg('bad end time argument "' + args[2] + '" in day spec.', code='bad-time')
+            elif not self._redefining('day') and not self._set_hours(start, end):
+                self._msg_day_redefined(self._universe.currentday.date)
+
+    def _msg_day_redefined(self, date):
+        self._msg('day ' + str(date) + ' redefined.', code='day-redefined')
+
+    def _set_current_day(self, datestring):
+        days = self._identity.days
+        
+        if datestring in days:
+            self._universe.currentday = days[datestring]
+        else:
+            self._universe.currentday = Day(datestring)
+            days[datestring] = self._universe.currentday
+    
+    def _set_hours(self, start, end):
+        return self._universe.currentday.set_hours(start, end)
 
     def _make_weekday(self, day):
         if not day in day_map:
-            self._msg('unknown day "' + day + '".')
+            self._msg('unknown day "' + day + '".', code='unknown-weekday')
             return None
         else:
             return day_map[day]
         
     def _process_must_hours(self, args):
-        must_hours = [0.0] * 7
+        must_hours = [0] * 7
         
         for arg in args:
             day, equals, hours = arg.partition('=')
             
             if equals != '=':
-                self._msg('bad must-hours argument "' + arg + '".')
+                self._msg('bad must-hours argument "' + arg + '".', code='must-hours-args')
             else:
                 first, dots, last = day.partition('..')
                 
@@ -810,45 +2004,59 @@ class Reader:
                 if first_day == None or last_day == None:
                     pass
                 elif last_day < first_day:
-                    self._msg('bad must-hours day range "' + day + '".')
+                    self._msg('bad must-hours day range "' + day + '".', code='must-hours-range')
                 else:
                     hrs = make_time(hours)
 
                     if hrs is None:
-                        self._msg('bad time duration "' + hours + '" ("' + day + '").')
+                        self._msg('bad time duration "' + hours + '" ("' + day + '").', code='bad-time')
                     else:
                         for d in range(first_day, last_day + 1):
-                            must_hours[d] = make_time(hours)
+                            must_hours[d] = hrs
     
-        if self._universe.currentday is None:
-            self._universe.musthours = must_hours
-        else:
+        if self._universe.currentday is not None:
             self._universe.currentday.musthours = must_hours
+        elif self._identity.name is not None:
+            self._identity.musthours = must_hours
+        else:
+            self._universe.musthours = must_hours
+
+    #   identity <short_name> (<name_bit>)*
+    def _set_identity(self, args):
+        if len(args) == 0 or args[0] == '':
+            self._msg('argument missing in instruction "identity".', code='missing-argument')
+            return
+        
+        fullname = ' '.join(args[1:]) if len(args) > 1 else None
+        self._switch_identity(args[0], fullname)
+    
+    def _switch_identity(self, name, fullname):
+        self._identity = self._universe.get_identity(name, fullname)
+        self._universe.currentday = None
 
     def _current_day_ok(self, args):
         currday_ok = self._universe.currentday is not None
         if not currday_ok:
-            self._msg('no current day for instruction "' + ' '.join(args) + '".')
+            self._msg('no current day for instruction "' + ' '.join(args) + '".', code='no-current-day')
         return currday_ok
     
     def _set_time(self, args, comment, setter, default_ok=False):
         if self._current_day_ok(args):
             if len(args) == 1:
-                if default_ok:
-                    tm = True
-                else:
-                    self._msg('argument missing in instruction "' + ' '.join(args) + '".')
+                if not default_ok:
+                    self._msg('argument missing in instruction "' + ' '.join(args) + '".', code='missing-argument')
                     return
+                tm = None # the whole day
             elif len(args) == 2:
                 tm = make_time(args[1])
+                if tm is None:
+                    self._msg('bad time "' + args[1] + '" in instruction "' + ' '.join(args) + '".', code='bad-time')
+                    return
             else:
-                self._msg('too many arguments in instruction "' + ' '.join(args) + '".')
+                self._msg('too many arguments in instruction "' + ' '.join(args) + '".', code='too-many-arguments')
                 return
             
-            if tm is None:
-                self._msg('bad time "' + args[1] + '" in instruction "' + ' '.join(args) + '".')
-            else:
-                setter(self._universe.currentday, tm, comment)
+            setter(self._universe.currentday, tm, comment)
     
     def _process_instruction(self, argliststring, comment=None):
         arglist = argliststring.split(' ')
@@ -860,26 +2068,28 @@ class Reader:
             return
         
         if instr == 'leave-days':
-            self._add_block(lambda day, cmnt: day.add_leave(True, cmnt), args[0], args[1], comment)
+            self._add_block(lambda day, cmnt: day.add_leave(None, cmnt), args[0], args[1], comment)
             return
         
         if instr == 'sick-days':
-            self._add_block(lambda day, cmnt: day.add_sick(True, cmnt), args[0], args[1], comment)
+            self._add_block(lambda day, cmnt: day.add_sick(None, cmnt), args[0], args[1], comment)
             return
         
         if instr == 'must-hours':
             self._process_must_hours(args)
             return
+        
+        if instr == 'identity' or instr == 'id':
+            self._set_identity(args)
+            return
 
         currday = self._universe.currentday
 
         if instr == 'phol' or instr == 'public-holiday':
             if self._current_day_ok(arglist):
                 currday.set_phol(comment)
-        else:
-            if self._already_read_before:
-                self._msg_redef(instr)
-            elif instr == 'reset':
+        elif not self._redefining(instr):
+            if instr == 'reset':
                 if self._current_day_ok(arglist):
                     currday.add_directive(Directive().set_reset())
             elif instr == 'add-leave':
@@ -898,7 +2108,209 @@ class Reader:
             elif instr == 'leave':
                 self._set_time(arglist, comment, lambda day, tm, cmnt: day.add_leave(tm, cmnt), True)
             else:
-                self._msg('weird instruction "' + argliststring + '".')
+                self._msg('weird instruction "' + argliststring + '".', code='unknown-instruction')
+
+class _NoDay:
+    '''Stands in for the current day while linting and ignores
+    everything done to it.'''
+    def __getattr__(self, name):
+        return lambda *args: None
+
+class Linter(Reader):
+    '''Scans an input file for the messages a Reader would give, without
+    building days and activities. Everything depending on other files
+    (work package names, current day, day hours, re-definitions,
+    imports) is recorded as events in reading order, to be replayed by
+    a _LintReplay once all files have been scanned.'''
+    def __init__(self):
+        super().__init__(Universe(), verbose=False)
+    
+    def scan(self, inputfile):
+        '''Return the events of the given file, or the message if it
+        cannot be opened.'''
+        self._events = []
+        self._recorded_line = None
+        self._universe.currentday = _NoDay()
+        self._start(inputfile)
+        
+        failure = self._read_input(inputfile, None)
+        return self._events if failure is None else failure
+    
+    def _record(self, *event):
+        if self._recorded_line != self._linecount:
+            self._recorded_line = self._linecount
+            self._events.append(('line', self._linecount))
+        self._events.append(event)
+    
+    def _msg(self, text, kind='ERROR', code='error'):
+        self._record('msg', text, kind, code)
+    
+    def _redefining(self, text):
+        self._record('redef', text)
+        return False
+    
+    def _current_day_ok(self, args):
+        self._record('need-day', args)
+        return True
+    
+    def _process_workpackage(self, line):
+        stack = self._workpackage_stack
+        super()._process_workpackage(line)
+        if self._workpackage_stack is not stack:
+            self._record('def', self._workpackage_stack.workpackage.get_path())
+    
+    def _process_instruction(self, argliststring, comment=None):
+        if self._recorded_line == self._linecount:
+            self._events.append(('instr',))
+        super()._process_instruction(argliststring, comment)
+    
+    def _lookup_workpackage(self, workpackage_name, workpackages=None):
+        self._record('ref', workpackage_name)
+        return workpackage_name
+    
+    def _attach_activity(self, wp, minutes, desc):
+        pass
+    
+    def _process_comment(self, comment):
+        pass
+    
+    def _add_block(self, day_setter, start, end, comment):
+        self._record('block', make_date(start).toordinal(), make_date(end).toordinal())
+    
+    def _new_day(self, args):
+        super()._new_day(args)
+        self._events.append(('instr',))
+    
+    def _set_current_day(self, datestring):
+        self._record('day', datestring, str(make_date(datestring)))
+    
+    def _set_hours(self, start, end):
+        self._record('hours', start, end)
+        return True
+    
+    def _has_hours(self, datestring, start, stop):
+        self._record('has-hours', datestring, start, stop)
+        return False
+    
+    def _switch_identity(self, name, fullname):
+        self._record('identity', name, fullname)
+    
+    def _import_file(self, file):
+        self._record('import', self._import_path(file))
+    
+    def _load_archive(self, f):
+        header, days, comments, activities = read_archive(f)
+        for path, effort, description in header['workpackages']:
+            self._record('def', path)
+        
+        for i in range(0, len(days), _archive_day_fields):
+            ordinal, identity, start, stop = days[i:i + 4]
+            self._record('archive-day', header['identities'][identity][0], str(date.fromordinal(ordinal)),
+                         None if start < 0 else start, None if stop < 0 else stop)
+        return []
+
+class _LintReplay(Reader):
+    '''Replays the events of scanned files in reading order, following
+    their imports, and adds their messages to the universe's
+    diagnostics. Only the work package tree of the universe is built;
+    the current day is kept as a tuple (identity name, date string,
+    date) and the days as a dict from (identity name, date string) to
+    their (start, stop) hours.'''
+    def __init__(self, uni, parent=None, scans=None):
+        super().__init__(uni, parent)
+        self._scans = scans if parent is None else parent._scans
+        self._days = {} if parent is None else parent._days
+    
+    def _read_input(self, inputfile, content):
+        events = self._scans[inputfile]
+        if isinstance(events, str):
+            return events
+        
+        self._universe.add_file(inputfile)
+        skipping = False
+        for event in events:
+            kind = event[0]
+            if kind == 'line':
+                self._linecount = event[1]
+                skipping = False
+            elif kind == 'instr':
+                skipping = False
+            elif skipping:
+                pass
+            elif kind == 'msg':
+                self._msg(*event[1:])
+            elif kind == 'redef':
+                skipping = self._redefining(event[1])
+            elif kind == 'need-day':
+                skipping = not self._current_day_ok(event[1])
+            elif kind == 'def':
+                self._universe.workpackage_root.get_node(event[1], create=True)
+            elif kind == 'ref':
+                if self._universe.get_workpackage(event[1]) is None:
+                    self._msg_unknown_workpackage(event[1])
+            elif kind == 'day':
+                self._universe.currentday = (self._identity.name,) + event[1:]
+                self._days.setdefault(self._universe.currentday[:2], (None, None))
+            elif kind == 'hours':
+                key = self._universe.currentday[:2]
+                if self._days[key] != (None, None):
+                    self._msg_day_redefined(self._universe.currentday[2])
+                else:
+                    self._days[key] = event[1:]
+            elif kind == 'has-hours':
+                hours = self._days.get((self._identity.name, event[1]))
+                skipping = hours is not None and hours[0] is not None and hours == event[2:]
+            elif kind == 'block':
+                for d in range(event[1], event[2] + 1):
+                    self._days.setdefault((self._identity.name, str(date.fromordinal(d))), (None, None))
+            elif kind == 'archive-day':
+                if event[1:3] in self._days:
+                    self._msg_day_redefined(event[2])
+                else:
+                    self._days[event[1:3]] = event[3:]
+            elif kind == 'identity':
+                self._switch_identity(*event[1:])
+            elif kind == 'import':
+                _LintReplay(self._universe, self).read(event[1])
+        return None
+    
+    def _finish(self):
+        self._universe.currentday = None
+
+def _scan_file(path):
+    return Linter().scan(path)
+
+def lint_files(universe, paths, workers=1):
+    '''Check the given files and the files they import for the messages
+    reading them would give, without building days and activities, and
+    print the messages. With more than one worker the files are scanned
+    in parallel processes (where fork is available), first the given
+    ones, then the ones they import and so on. Returns the number of
+    files checked.'''
+    scans = {}
+    pending = list(dict.fromkeys(paths))
+    while len(pending) > 0:
+        files = [ p for p in pending if p != '-' ]
+        if workers > 1 and len(files) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context('fork').Pool(min(workers, len(files))) as pool:
+                scans.update(zip(files, pool.map(_scan_file, files)))
+        for path in pending:
+            if path not in scans:
+                scans[path] = _scan_file(path)
+        
+        imports = [ e[1] for p in pending if not isinstance(scans[p], str)
+                    for e in scans[p] if e[0] == 'import' ]
+        pending = [ p for p in dict.fromkeys(imports) if p not in scans ]
+    
+    replay = _LintReplay(universe, scans=scans)
+    for path in paths:
+        replay.read(path)
+    universe.diagnostics.flush()
+    return len(universe.inputfiles)
+
+# The hour fields of a Status.
+_status_fields = ('_musthours', '_balancehours', '_leavebalancehours',
+                  '_leavetakenhours', '_sickhours', '_workedhours')
 
 class Status:
     def __init__(self, name):
@@ -912,163 +2324,1476 @@ class Status:
         self._leavetakenhours = 0
         self._sickhours = 0
         self._workedhours = 0
+        self._fixed = _status_fields
+    
+    def start_segment(self):
+        '''Start over as a segment: the Status of the days processed
+        from now on, which can be applied to the Status of the days
+        before them with combine().'''
+        self.reset()
+        self._fixed = ()
+    
+    def combine(self, segment):
+        '''Apply a segment that follows the days of this Status. The
+        fields the segment has set since it started (by a reset or a
+        directive) replace ours, the others add up. Combining is
+        associative, so segments can be combined in any grouping.'''
+        for field in _status_fields:
+            if field in segment._fixed:
+                setattr(self, field, getattr(segment, field))
+            else:
+                setattr(self, field, getattr(self, field) + getattr(segment, field))
+        if self._fixed is not _status_fields:
+            fixed = tuple(f for f in _status_fields if f in self._fixed or f in segment._fixed)
+            self._fixed = _status_fields if fixed == _status_fields else fixed
+    
+    def resolve_row(self, row):
+        '''Complete a row that a segment following this Status reported
+        with the hours of the days before the segment.'''
+        status = copy.copy(self)
+        status.combine(row.segment)
+        resolved = status.tally_row(None)
+        row.worked = resolved.worked
+        row.leave = resolved.leave
+        row.sick = resolved.sick
+        row.balance = resolved.balance
+        row.segment = None
+
+    def merge(self, other):
+        '''Add the hours accumulated in another Status to ours.'''
+        self._musthours += other._musthours
+        self._balancehours += other._balancehours
+        self._leavebalancehours += other._leavebalancehours
+        self._leavetakenhours += other._leavetakenhours
+        self._sickhours += other._sickhours
+        self._workedhours += other._workedhours
 
     def increase_must_hours(self, dt):
         # public holidays?
         workday = not is_weekend(dt)
         if workday:
-            self._musthours += 8
+            self._musthours += 480
         return workday
     
     def process_day(self, day):
+        '''Add the day's hours. Returns the row reporting the totals
+        before a reset if the day has a reset directive, None
+        otherwise.'''
+        resetrow = None
         if day.directives is not None:
             for di in day.directives:
+                if di.reset:
+                    resetrow = self.tally_row('reset')
                 self._process_directive(di)
 
-        self._musthours += day.calc_required()
-        self._balancehours += day.calc_balance()
-        self._workedhours += day.calc_worked()
-        self._sickhours += get_value(day.sick)
-        self._leavebalancehours -= get_value(day.leave)
-        self._leavetakenhours += get_value(day.leave)
+        self.add_day(day)
+        return resetrow
+    
+    def add_day(self, day, sign=1):
+        '''Add the day's hours, or take them back with sign -1. The
+        day's directives are not looked at.'''
+        self._musthours += sign * day.calc_required()
+        self._balancehours += sign * day.calc_balance()
+        self._workedhours += sign * day.calc_worked()
+        self._sickhours += sign * day.sick
+        self._leavebalancehours -= sign * day.leave
+        self._leavetakenhours += sign * day.leave
+    
+    def values(self):
+        return (self._musthours, self._balancehours, self._leavebalancehours,
+                self._leavetakenhours, self._sickhours, self._workedhours)
         
     def _process_directive(self, di):
         if di.reset:
-            self.dump('reset')
             self.reset()
         elif di.leave is not None:
             self._leavebalancehours += di.leave
         elif di.must is not None:
             self._musthours = di.must
+            if '_musthours' not in self._fixed:
+                self._fixed = self._fixed + ('_musthours',)
         elif di.have is not None:
             self._havehours = di.have
         
-    def dump(self, tag):
+    def tally_row(self, tag):
         if tag is None:
             prefix = self.name
         else:
             prefix = self.name + ' ' + tag
-            
-        output('{0:>14s}: '.format(prefix) +\
-              format_floatval(self._workedhours) + ' ' +\
-              format_floatval(self._leavetakenhours) + ' ' +\
-              format_floatval(self._sickhours) + ' ' +\
-              format_floatval(self._balancehours))
+        
+        row = TallyRow(self.name, prefix, self._workedhours, self._leavetakenhours,
+                       self._sickhours, self._balancehours)
+        if self._fixed is not _status_fields:
+            row.segment = copy.copy(self)
+        return row
+    
+    def dump(self, tag):
+        output(self.tally_row(tag).format())
+    
+class RollingWindow:
+    '''The sums of the time worked and of the balance over the days of
+    the last 'days' calendar days. Days are added in chronological
+    order; each one is added and dropped exactly once.'''
+    def __init__(self, days):
+        self.days = days
+        self.worked = 0
+        self.balance = 0
+        self._window = collections.deque()
+        self._next = 0
     
+    def add_upto(self, index, i):
+        '''Add the day at position i of the day index, after the days
+        before it in the window that have not been added yet, whether
+        they pass the filter or not.'''
+        ordinals = index.ordinals
+        first = max(self._next, bisect.bisect_left(ordinals, ordinals[i] - self.days + 1))
+        for j in range(first, i + 1):
+            d = index.days[j]
+            self.add(ordinals[j], d.calc_worked(), d.calc_balance())
+        self._next = i + 1
+    
+    def add(self, ordinal, worked, balance):
+        self._window.append((ordinal, worked, balance))
+        self.worked += worked
+        self.balance += balance
+        
+        first = ordinal - self.days
+        while self._window[0][0] <= first:
+            o, w, b = self._window.popleft()
+            self.worked -= w
+            self.balance -= b
+    
+    def weekly(self):
+        '''The weekly averages of time worked and balance.'''
+        return self.worked * 7 / self.days, self.balance * 7 / self.days
+
 class Statistics:
-    def __init__(self, universe):
-        self.days = universe.get_chrono_days()
+    '''Day based reports for the days of one identity.'''
+    def __init__(self, identity):
+        self.index = identity.day_index
+        self.days = self.index.days
         self.totals = Status('total')
         self.weekly = Status('week')
         self.monthly = Status('month')
         self.prev_day = None
 
-    def _process_gap(self, d1, dayfilter):
+    def _process_gap(self, end, dayfilter):
+        '''Generate the rows of the days without record that pass the
+        filter between the previous day processed and ordinal end.'''
         if self.prev_day is None:
             return
-
-        d = self.prev_day.date.toordinal() + 1
-        end = d1.date.toordinal()
-
-        while d < end:
+        
+        ordinals = self.index.ordinals
+        for d in dayfilter.covered(self.prev_ordinal + 1, end - 1):
+            i = bisect.bisect_left(ordinals, d)
+            if i < len(ordinals) and ordinals[i] == d:
+                continue
             dt = date.fromordinal(d)
-            if dayfilter.passes(Day(dt)) and self.totals.increase_must_hours(dt):
-                output('missing weekday record for ' + str(dt))
-            d = d + 1
+            if self.totals.increase_must_hours(dt):
+                yield TallyRow('missing', str(dt))
 
-    def check_days(self, dayfilter):
-        warnings = 0
-        for d in self.days:
-            if dayfilter.passes(d):
-                dt_str = d.date.strftime('%Y-%m-%d %a')
+    def check(self, dayfilter):
+        '''Generate the DayProblems of the days passing the filter.'''
+        for i in dayfilter.select(self.index):
+            yield from self._check_day(self.days[i])
+    
+    def _check_day(self, d):
+        worked = d.calc_worked()
+        allocated = d.calc_activity()
+        
+        if allocated != worked:
+            yield DayProblem(d, 'allocation', allocated, worked)
 
-                worked = d.calc_worked()
-                allocated = d.calc_activity()
-                delta = allocated - worked
-                
-                if delta != 0.0:
-                    warnings += 1
-                    output('{0:s}: worked {1:5.2f}, allocated {2:5.2f}, delta {3:5.2f}'
-                          .format(dt_str, worked, allocated, delta))
-
-                sick = get_value(d.sick)
-                leave = get_value(d.leave)
-                more_sick = sick > d.required
-                more_leave = leave > d.required
-                
-                if more_sick:
-                    output(dt_str + ': more sick time ('
-                            + str(sick) + ') taken than required working time ('
-                            + str(d.required) + ').')
-                    warnings += 1
-                
-                if more_leave:
-                    output(dt_str + ': more leave time ('
-                            + str(leave) + ') taken than required working time ('
-                            + str(d.required) + ').')
-                    warnings += 1
-                
-                if (not more_leave) and (not more_sick) and sick + leave > d.required:
-                    output(dt_str + ': more leave and sick time ('
-                            + str(leave + sick) + ') taken than required working time ('
-                            + str(d.required) + ').')
-                    warnings += 1
-
-        if warnings != 0:
-            output(plural(warnings, 'problem') + ' detected.')
+        sick = d.sick
+        leave = d.leave
+        more_sick = sick > d.required
+        more_leave = leave > d.required
+        
+        if more_sick:
+            yield DayProblem(d, 'sick', sick, d.required)
+        
+        if more_leave:
+            yield DayProblem(d, 'leave', leave, d.required)
+        
+        if (not more_leave) and (not more_sick) and sick + leave > d.required:
+            yield DayProblem(d, 'leave and sick', leave + sick, d.required)
+    
+    def check_chunk(self, positions, prev, options):
+        '''The problems of the days at the given positions of the day
+        index as (position, kind, amount, reference) tuples.'''
+        return [ (i, p.kind, p.amount, p.reference)
+                 for i in positions for p in self._check_day(self.days[i]) ]
+    
+    def check_chunked(self, dayfilter, chunk_days, workers=1):
+        '''Generate the same DayProblems as check(), with the days split
+        into chunks of chunk_days days that are checked by worker
+        processes.'''
+        positions = list(dayfilter.select(self.index))
+        for problems in self._map_chunks('check_chunk', positions, {}, chunk_days, workers):
+            for i, kind, amount, reference in problems:
+                yield DayProblem(self.days[i], kind, amount, reference)
+
+    def check_days(self, dayfilter, chunk_days=None, workers=1):
+        if chunk_days:
+            dump_problems(self.check_chunked(dayfilter, chunk_days, workers))
         else:
-            output('ok.')
+            dump_problems(self.check(dayfilter))
+    
+    def tally(self, options, chunk_days=None, workers=1):
+        '''Generate the TallyRows of the time at work overview. The
+        options are those of calc_balance() without 'comments'. With
+        option 'rolling' (a number of days) the rows other than
+        missing days carry the weekly averages of the time worked and
+        the balance over that many days up to the row. With chunk_days
+        the days are tallied in chunks of that many days by worker
+        processes (except with option 'rolling'), with the same rows
+        as the result.'''
+        if chunk_days and not options.get('rolling'):
+            yield from self._tally_chunked(options, chunk_days, workers)
+            return
+        
+        window = RollingWindow(options['rolling']) if options.get('rolling') else None
         
-    def calc_balance(self, options):
+        for row in self._tally(options, window):
+            if window is not None and row.kind != 'missing':
+                row.rolling = window.weekly()
+            yield row
+    
+    def _tally(self, options, window):
+        self._start_tally(None)
+        yield from self._tally_days(options['time'].select(self.index), options, window)
+        yield from self._finish_tally(options)
+    
+    def _start_tally(self, prev):
+        '''Start after the day at position prev of the day index, or at
+        the beginning if prev is None.'''
+        index = self.index
+        if prev is None:
+            self.prev_month = None
+            self.prev_week = None
+            self.prev_day = None
+            self.prev_ordinal = None
+        else:
+            self.prev_month = index.months[prev]
+            self.prev_week = index.weeks[prev]
+            self.prev_day = self.days[prev]
+            self.prev_ordinal = index.ordinals[prev]
+    
+    def _tally_days(self, positions, options, window):
+        '''Generate the rows of the days at the given positions of the
+        day index and of the days without record and the periods ending
+        before them.'''
         dayfilter = options['time']
         do_daily = options['day']
         do_weekly = options['week']
         do_monthly = options['month']
-        self.prev_month = None
-        self.prev_week = None
-        self.prev_day = None
+        index = self.index
         
-        dump_day_header()
-        
-        for d in self.days:
-            self._process_gap(d, dayfilter)
-            if dayfilter.passes(d):
-                year, week = d.date.isocalendar()[0:2]
-                this_month = str(year) + '-{0:02d}'.format(int(d.date.month))
-                this_week = str(year) + '-{0:02d}'.format(int(week))
-                if self.prev_day is not None:
-                    if do_weekly and this_week != self.prev_week:
-                        self.weekly.dump(self.prev_week)
-                        self.weekly.reset()
-                    if do_monthly and this_month != self.prev_month:
-                        self.monthly.dump(self.prev_month)
-                        self.monthly.reset()
-                    
-                self.weekly.process_day(d)
-                self.monthly.process_day(d)
-                self.totals.process_day(d)
+        for i in positions:
+            d = self.days[i]
+            ordinal = index.ordinals[i]
+            yield from self._process_gap(ordinal, dayfilter)
+            this_month = index.months[i]
+            this_week = index.weeks[i]
+            if self.prev_day is not None:
+                if do_weekly and this_week != self.prev_week:
+                    yield self.weekly.tally_row(format_period_key(self.prev_week))
+                    self.weekly.reset()
+                if do_monthly and this_month != self.prev_month:
+                    yield self.monthly.tally_row(format_period_key(self.prev_month))
+                    self.monthly.reset()
+            
+            for status in self.weekly, self.monthly, self.totals:
+                resetrow = status.process_day(d)
+                if resetrow is not None:
+                    yield resetrow
+            
+            if window is not None:
+                window.add_upto(index, i)
+
+            if do_daily and (d.calc_have() > 0 or d.is_workday()):
+                yield d.tally_row()
+
+            self.prev_day = d
+            self.prev_ordinal = ordinal
+            self.prev_week = this_week
+            self.prev_month = this_month
+    
+    def _finish_tally(self, options):
+        # the days without record up to the last one
+        if len(self.days) > 0:
+            yield from self._process_gap(self.index.ordinals[-1], options['time'])
+
+        if options['week']:
+            yield self.weekly.tally_row(format_period_key(self.prev_week))
+        if options['month']:
+            yield self.monthly.tally_row(format_period_key(self.prev_month))
+        yield self.totals.tally_row(None)
+    
+    def tally_chunk(self, positions, prev, options):
+        '''Tally the days at the given positions of the day index, which
+        follow the day at position prev (None for none). The week, month
+        and total Status start as segments, so the rows of the periods
+        carry the segment to be completed (see Status.resolve_row()).
+        Returns the rows, as (position of the day or None, row)
+        tuples, and the three segments.'''
+        self.weekly = Status('week')
+        self.monthly = Status('month')
+        self.totals = Status('total')
+        for status in self.weekly, self.monthly, self.totals:
+            status.start_segment()
+        self._start_tally(prev)
+        
+        rows = []
+        for row in self._tally_days(positions, options, None):
+            position = None
+            if row.day is not None:
+                position = bisect.bisect_left(self.index.ordinals, row.day.date.toordinal())
+                row.day = None
+            rows.append((position, row))
+        return rows, (self.weekly, self.monthly, self.totals)
+    
+    def _tally_chunked(self, options, chunk_days, workers):
+        statuses = { s.name:s for s in (self.weekly, self.monthly, self.totals) }
+        positions = list(options['time'].select(self.index))
+        for rows, segments in self._map_chunks('tally_chunk', positions, options, chunk_days, workers):
+            for position, row in rows:
+                if position is not None:
+                    row.day = self.days[position]
+                elif row.segment is not None:
+                    statuses[row.kind].resolve_row(row)
+                yield row
+            for segment in segments:
+                statuses[segment.name].combine(segment)
+        
+        self._start_tally(positions[-1] if len(positions) > 0 else None)
+        yield from self._finish_tally(options)
+    
+    def _map_chunks(self, method, positions, options, chunk_days, workers):
+        '''Split the positions of the day index into chunks of chunk_days
+        days and return the results of the method (tally_chunk or
+        check_chunk) for each of them, in order. With more than one
+        worker the chunks are processed in parallel processes (where
+        fork is available).'''
+        global _chunk_statistics
+        jobs = [ (method, positions[i:i + chunk_days], positions[i - 1] if i > 0 else None, options)
+                 for i in range(0, len(positions), chunk_days) ]
+        
+        if workers > 1 and len(jobs) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            _chunk_statistics = self
+            try:
+                with multiprocessing.get_context('fork').Pool(min(workers, len(jobs))) as pool:
+                    return pool.map(_process_chunk, jobs)
+            finally:
+                _chunk_statistics = None
+        
+        # the chunk methods replace the Status of a Statistics
+        chunked = copy.copy(self)
+        return [ getattr(chunked, job[0])(*job[1:]) for job in jobs ]
+    
+    def calc_balance(self, options, chunk_days=None, workers=1):
+        dump_tally(self.tally(options, chunk_days, workers), options)
+
+# The Statistics whose days are processed in chunks by the worker
+# processes forked in Statistics._map_chunks().
+_chunk_statistics = None
+
+def _process_chunk(job):
+    return getattr(_chunk_statistics, job[0])(*job[1:])
+
+class ReferenceEngine:
+    '''The calculations behind the work package summary, the plan vs.
+    actual report, the time at work overview and the day check of a
+    universe: WorkPackage.calc_activity() and the Statistics of each
+    identity. Other engines (see _engines) must give the same results;
+    option --verify-engine compares them with this one. The days of
+    the tally and the check are processed in chunks if chunk_days is
+    given (see Statistics.tally()).'''
+    name = 'reference'
+    
+    def __init__(self, universe, chunk_days=None, workers=1):
+        self.universe = universe
+        self.chunk_days = chunk_days
+        self.workers = workers
+    
+    def activity(self, wp, options, plan=False):
+        '''The ValueNode tree of the work package, as calculated by
+        calc_activity() with the time filter, depth, minimum value and
+        activities of the report options.'''
+        return wp.calc_activity(options['time'], options.get('depth'), options.get('min-value', 0),
+                                'activities' in options, plan)
+    
+    def tally(self, identity, options):
+        '''The TallyRows of the identity's time at work overview.'''
+        return Statistics(identity).tally(options, self.chunk_days, self.workers)
+    
+    def check(self, identity, dayfilter):
+        '''The DayProblems of the identity's days passing the filter.'''
+        stats = Statistics(identity)
+        if self.chunk_days:
+            return stats.check_chunked(dayfilter, self.chunk_days, self.workers)
+        return stats.check(dayfilter)
+
+class IndexedEngine(ReferenceEngine):
+    '''Calculates the work package trees from the days the time filter
+    selects in the day index of each identity, so that the days outside
+    the filter are not looked at and the day of an activity is not
+    tested for each work package.'''
+    name = 'indexed'
+    
+    def activity(self, wp, options, plan=False):
+        dayfilter = options['time']
+        if isinstance(dayfilter, AllFilter):
+            # every activity counts, there are no days to skip
+            return ReferenceEngine.activity(self, wp, options, plan)
+        
+        booked = {}
+        covered = set()
+        for identity in self.universe.identities.values():
+            days = identity.day_index.days
+            for i in dayfilter.select(identity.day_index):
+                day = days[i]
+                if day.activities is None:
+                    continue
+                covered.add(day)
+                for a in day.activities:
+                    minutes = booked.get(a.workpackage())
+                    if minutes is None:
+                        booked[a.workpackage()] = [ a.duration, 1 ]
+                    else:
+                        minutes[0] += a.duration
+                        minutes[1] += 1
+        
+        return self._build(wp, booked, covered, options.get('depth'), options.get('min-value', 0),
+                           'activities' in options, plan)
+    
+    def _build(self, wp, booked, covered, depth, min_value, activities, plan):
+        '''The ValueNode tree of the work package from the time booked
+        on each work package ([minutes, activities]) on the covered
+        days, pruned like calc_activity() does.'''
+        if depth == 0:
+            totals = 0
+            effort = 0
+            acts = [] if activities else None
+            stack = [ wp ]
+            while len(stack) > 0:
+                w = stack.pop()
+                effort += w.effort or 0
+                if w in booked:
+                    totals += booked[w][0]
+                    if activities:
+                        acts.extend(a for a in w._activities if a.day() in covered)
+                if w._children is not None:
+                    stack.extend(w._children)
+            if acts:
+                acts.sort(key=lambda a: a.day().date)
+            res = ValueNode(wp, totals, acts or None)
+            res.effort = effort
+            return res
+        
+        res = ValueNode(wp)
+        effort = wp.effort or 0
+        totals, own = booked.get(wp, (0, 0))
+        acts = None
+        if activities:
+            acts = [ a for a in wp.activities if a.day() in covered ] if own > 0 else []
+        
+        subdepth = None if depth is None else depth - 1
+        children = []
+        folded = False
+        
+        if wp._children is not None:
+            for s in wp._children:
+                c = self._build(s, booked, covered, subdepth, min_value, activities, plan)
+                effort += c.effort
+                if (c.value != 0 and c.value >= min_value) or (plan and c.effort != 0):
+                    children.append(c)
+                elif c.value != 0:
+                    totals += c.value
+                    own += 1
+                    if activities:
+                        acts.extend(c.activities)
+                        folded = True
+        
+        if folded:
+            acts.sort(key=lambda a: a.day().date)
+        
+        if (own > 0 or (plan and wp.effort)) and len(children) > 0:
+            selfres = ValueNode(None, totals, acts or None)
+            selfres.effort = wp.effort or 0
+            res.add_child(selfres)
+            acts = None
+        
+        for c in children:
+            totals += c.value
+            res.add_child(c)
+        
+        res.value = totals
+        res.effort = effort
+        res.activities = acts if acts else None
+        return res
+
+# The engines selectable with option --engine.
+_engines = { e.name:e for e in (ReferenceEngine, IndexedEngine) }
+
+def engine_reports(engine, options):
+    '''The lines of the reports an engine calculates for its universe
+    with the given report options, as (report title, lines) tuples:
+    the work package summary, the plan vs. actual report and, for each
+    person, the time at work overview and the day check.'''
+    universe = engine.universe
+    reports = []
+    
+    def capture(title, report):
+        with output_to(io.StringIO()) as buf:
+            report()
+        reports.append((title, buf.getvalue().splitlines()))
+    
+    root = universe.workpackage_root
+    capture('work package summary', lambda: engine.activity(root, options).dump(options))
+    plan = dict(options, plan=True, weeks=period_weeks(universe, options['time']))
+    capture('plan vs. actual', lambda: engine.activity(root, options, True).dump(plan))
+    for person in universe.get_people():
+        label = '' if person.name is None else ' of ' + person.label()
+        capture('time at work overview' + label, lambda: dump_tally(engine.tally(person, options), options))
+        capture('day check' + label, lambda: dump_problems(engine.check(person, options['time'])))
+    return reports
+
+def verify_engine(engine, options):
+    '''Compare the reports of an engine with those of the reference
+    engine on the same universe. Returns a list of (report title,
+    number of lines, first difference) tuples, where the difference is
+    None or a tuple of the line number and the reference and engine
+    lines (None past the end).'''
+    results = []
+    reference = engine_reports(ReferenceEngine(engine.universe), options)
+    for (title, expected), (_, lines) in zip(reference, engine_reports(engine, options)):
+        difference = None
+        for i in range(max(len(expected), len(lines))):
+            want = expected[i] if i < len(expected) else None
+            have = lines[i] if i < len(lines) else None
+            if want != have:
+                difference = (i + 1, want, have)
+                break
+        results.append((title, len(expected), difference))
+    return results
+
+def weekdays_between(first, last):
+    '''The number of weekdays (Monday to Friday) from ordinal first to
+    ordinal last. Ordinal 1 is a Monday.'''
+    def weekdays_upto(n):
+        return n // 7 * 5 + min(n % 7, 5)
+    return max(0, weekdays_upto(last) - weekdays_upto(first - 1))
+
+def period_weeks(universe, dayfilter):
+    '''The number of weeks from the first to the last day (of anyone)
+    passing the filter, 0 if there is none.'''
+    first = last = None
+    for identity in universe.identities.values():
+        positions = list(dayfilter.select(identity.day_index))
+        if len(positions) > 0:
+            ordinals = identity.day_index.ordinals
+            first = ordinals[positions[0]] if first is None else min(first, ordinals[positions[0]])
+            last = ordinals[positions[-1]] if last is None else max(last, ordinals[positions[-1]])
+    return 0 if first is None else (last - first + 1) / 7
+
+def _gap_must_hours(prev, following):
+    '''The must hours the time at work overview adds for the weekdays
+    between the day ordinals prev and following (None: no such day).'''
+    if prev is None or following is None:
+        return 0
+    return 480 * weekdays_between(prev + 1, following - 1)
+
+class Rollups:
+    '''Work package and period totals of a tidied universe that are
+    kept up to date while days are added, removed or replaced, in time
+    proportional to the change: only the totals of the work packages
+    on the paths of the day's activities and the Status of the day's
+    week and month are updated. The totals over all days are kept as
+    Status segments starting at the days with directives (see
+    Status.start_segment()); a change updates the segment of the day
+    by its hours, or refolds the segments next to it if the day has
+    directives, and the segments are combined again. A day with a
+    must-hours override changes the required time of the days after
+    it, so changing one recomputes everything.
+    
+    workpackages maps each work package to its [own, subtree] minutes,
+    periods maps (identity name, 'week' or 'month', key) to the Status
+    of the days with that week or month key of the DayIndex (YYYYWW or
+    YYYYMM, with the ISO year),
+    totals maps identity names to the Status over all days, as in the
+    time at work overview. check() compares all of them with a full
+    recompute.'''
+    def __init__(self, universe):
+        self.universe = universe
+        self._compute()
+    
+    def _compute(self):
+        self.workpackages = {}
+        self._sum_workpackage(self.universe.workpackage_root)
+        
+        self.periods = {}
+        self.totals = {}
+        self._starts = {}
+        self._segments = {}
+        self._overrides = {}
+        for name, identity in self.universe.identities.items():
+            days = identity.get_chrono_days()
+            self._overrides[name] = [ d.date.toordinal() for d in days if d.musthours is not None ]
+            for day in days:
+                for kind, key, ranges in self._periods_of(day):
+                    status = self.periods.setdefault((name, kind, key), Status(kind))
+                    status.process_day(day)
+            
+            # segment k + 1 starts at the k-th day with directives
+            starts = self._starts[name] = [ d.date.toordinal() for d in days if d.directives ]
+            self._segments[name] = [ self._fold_segment(identity, first)
+                                     for first in [ 0 ] + starts ]
+            self._combine_totals(name)
+    
+    def _sum_workpackage(self, wp):
+        own = sum(a.duration for a in wp.activities or ())
+        subtree = own + sum(self._sum_workpackage(c) for c in wp._children or ())
+        self.workpackages[wp] = [own, subtree]
+        return subtree
+    
+    def _periods_of(self, day):
+        '''The (kind, key, ordinal ranges) of the week and the month of
+        the day, keyed like in the DayIndex. As the year of the month
+        key is the ISO year, the days of a December or January key can
+        also lie in the same month of the year before or after.'''
+        dt = day.date
+        year, week, weekday = dt.isocalendar()
+        monday = dt.toordinal() - weekday + 1
+        years = [ year ]
+        if dt.month == 12:
+            years.append(year - 1)
+        elif dt.month == 1:
+            years.append(year + 1)
+        months = []
+        for y in years:
+            following = date(y + dt.month // 12, dt.month % 12 + 1, 1)
+            months.append((date(y, dt.month, 1).toordinal(), following.toordinal() - 1))
+        return (('week', year * 100 + week, [ (monday, monday + 6) ]),
+                ('month', year * 100 + dt.month, months))
+    
+    def _period_days(self, index, kind, key, ranges):
+        '''The days of the index with the given period key, looking
+        only at the ordinal ranges.'''
+        keys = index.weeks if kind == 'week' else index.months
+        ordinals = index.ordinals
+        days = []
+        for first, last in ranges:
+            for i in range(bisect.bisect_left(ordinals, first), bisect.bisect_right(ordinals, last)):
+                if keys[i] == key:
+                    days.append(index.days[i])
+        return days
+    
+    def _fold_totals(self, identity):
+        stats = Statistics(identity)
+        if len(stats.days) > 0:
+            for row in stats.tally(make_report_options()[0]):
+                pass
+        return stats.totals
+    
+    def _fold_segment(self, identity, first):
+        '''The totals segment of the days from ordinal first up to the
+        next day with directives, with the must hours the time at work
+        overview adds for the weekdays without record after each of
+        them. Segment 0 (first 0) has the days before any directive.'''
+        index = identity.day_index
+        ordinals = index.ordinals
+        starts = self._starts[identity.name]
+        k = bisect.bisect_right(starts, first)
+        lo = bisect.bisect_left(ordinals, first)
+        hi = len(ordinals) if k == len(starts) else bisect.bisect_left(ordinals, starts[k])
+        
+        segment = Status('total')
+        segment.start_segment()
+        for i in range(lo, hi):
+            segment.process_day(index.days[i])
+            if i + 1 < len(ordinals):
+                segment._musthours += _gap_must_hours(ordinals[i], ordinals[i + 1])
+        return segment
+    
+    def _combine_totals(self, name):
+        totals = Status('total')
+        for segment in self._segments[name]:
+            totals.combine(segment)
+        self.totals[name] = totals
+    
+    def _rebuild(self):
+        self.universe.tidy_up()
+        self._compute()
+    
+    def _add_activity(self, activity, sign):
+        wp = activity.workpackage()
+        self.workpackages.setdefault(wp, [0, 0])[0] += sign * activity.duration
+        while wp is not None:
+            self.workpackages.setdefault(wp, [0, 0])[1] += sign * activity.duration
+            wp = None if wp._parent is None else wp._parent()
+    
+    def _must_hours(self, identity, day):
+        '''The must hours in effect on the day.'''
+        overrides = self._overrides[identity.name]
+        i = bisect.bisect_right(overrides, day.date.toordinal())
+        if i > 0:
+            return identity.days[str(date.fromordinal(overrides[i - 1]))].musthours
+        elif identity.musthours is not None:
+            return identity.musthours
+        return self.universe.musthours
+    
+    def _day_changed(self, identity, day, sign):
+        '''Update the totals after the day was inserted into (sign 1)
+        or removed from (sign -1) the identity's day index.'''
+        name = identity.name
+        self.universe._search_index = None
+        
+        for kind, key, ranges in self._periods_of(day):
+            days = self._period_days(identity.day_index, kind, key, ranges)
+            if len(days) == 0:
+                del self.periods[(name, kind, key)]
+            else:
+                status = self.periods[(name, kind, key)] = Status(kind)
+                for d in days:
+                    status.process_day(d)
+        
+        ordinal = day.date.toordinal()
+        starts = self._starts[name]
+        segments = self._segments[name]
+        
+        if day.directives:
+            # the day starts a segment of its own; the one before it
+            # now ends before it (sign 1) or takes in its days (-1)
+            k = bisect.bisect_left(starts, ordinal)
+            if sign > 0:
+                starts.insert(k, ordinal)
+                segments.insert(k + 1, self._fold_segment(identity, ordinal))
+            else:
+                del starts[k]
+                del segments[k + 1]
+            segments[k] = self._fold_segment(identity, starts[k - 1] if k > 0 else 0)
+        else:
+            ordinals = identity.day_index.ordinals
+            i = bisect.bisect_left(ordinals, ordinal)
+            j = bisect.bisect_right(ordinals, ordinal)
+            prev = ordinals[i - 1] if i > 0 else None
+            following = ordinals[j] if j < len(ordinals) else None
+            
+            # the weekdays without record around the day
+            gaps = _gap_must_hours(prev, ordinal) + _gap_must_hours(ordinal, following) - \
+                   _gap_must_hours(prev, following)
+            segment = segments[bisect.bisect_right(starts, ordinal)]
+            segment.add_day(day, sign)
+            segment._musthours += sign * gaps
+        
+        self._combine_totals(name)
+    
+    def add_day(self, identity, day):
+        '''Add a new day to the identity. Its activities must be
+        attached to it and to their work packages, as done by the
+        reader.'''
+        datestring = str(day.date)
+        if datestring in identity.days:
+            raise ValueError('day ' + datestring + ' exists already')
+        identity.days[datestring] = day
+        
+        if day.musthours is not None:
+            self._rebuild()
+            return
+        
+        identity.day_index.insert(day)
+        day.tidy_up(self._must_hours(identity, day))
+        for a in day.activities or ():
+            a.workpackage().place_activity(a)
+            self._add_activity(a, 1)
+        self._day_changed(identity, day, 1)
+    
+    def remove_day(self, identity, datestring):
+        '''Remove the day of the given date from the identity, together
+        with its activities. Returns the day.'''
+        day = identity.days.pop(datestring)
+        for a in day.activities or ():
+            wp = a.workpackage()
+            wp.activities.remove(a)
+            if len(wp.activities) == 0:
+                wp.activities = None
+            self._add_activity(a, -1)
+        
+        if day.musthours is not None:
+            self._rebuild()
+            return day
+        
+        identity.day_index.remove(day)
+        self._day_changed(identity, day, -1)
+        return day
+    
+    def replace_day(self, identity, day):
+        '''Replace the identity's day of the same date. Returns the
+        old day.'''
+        old = self.remove_day(identity, str(day.date))
+        self.add_day(identity, day)
+        return old
+    
+    def check(self):
+        '''Compare the totals with a full recompute. Returns a list of
+        the differences found.'''
+        fresh = Rollups(self.universe)
+        problems = []
+        
+        for wp in fresh.workpackages:
+            have = self.workpackages.get(wp)
+            if have != fresh.workpackages[wp]:
+                problems.append('work package ' + (wp.get_path() or 'ALL') + ': ' +
+                                str(have) + ' instead of ' + str(fresh.workpackages[wp]))
+        
+        for key in sorted(set(self.periods) | set(fresh.periods), key=str):
+            have = self.periods[key].values() if key in self.periods else None
+            want = fresh.periods[key].values() if key in fresh.periods else None
+            if have != want:
+                problems.append(' '.join(str(k) for k in key) + ': ' + str(have) + ' instead of ' + str(want))
+        
+        for name in fresh.totals:
+            have = self.totals[name].values() if name in self.totals else None
+            want = self._fold_totals(self.universe.identities[name]).values()
+            if have != want:
+                problems.append('total ' + str(name) + ': ' + str(have) + ' instead of ' + str(want))
+        
+        return problems
+
+_team_universe = None
+
+def _tally_identity(job):
+    '''Run the day tally for one identity of _team_universe. This runs
+    in a worker process forked after the input has been read. Returns
+    the captured report text and the identity's totals.'''
+    name, options = job
+    return _tally_person(_team_universe.identities[name], options)
+
+def _tally_person(identity, options):
+    stats = Statistics(identity)
+    with output_to(io.StringIO()) as buf:
+        stats.calc_balance(options)
+    return buf.getvalue(), stats.totals
+
+def tally_team(universe, options, workers=1):
+    '''Tally the days of each person in the universe and print the
+    reports one after the other, followed by the team totals. With
+    more than one worker the tallies are calculated in parallel
+    processes (where fork is available).'''
+    global _team_universe
+    people = universe.get_people()
+    jobs = [ (p.name, options) for p in people ]
+    
+    if workers > 1 and len(jobs) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        _team_universe = universe
+        try:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                results = pool.map(_tally_identity, jobs)
+        finally:
+            _team_universe = None
+    else:
+        results = [ _tally_person(p, options) for p in people ]
+    
+    team = Status('team')
+    for person, (text, totals) in zip(people, results):
+        output(person.label() + ':')
+        output(text, end='')
+        team.merge(totals)
+    
+    output('Team (' + plural(len(people), 'person') + '):')
+    dump_day_header()
+    team.dump(None)
+
+def load_universe(sources, loader=None, lazy_text=False):
+    '''Build a universe from the given sources without printing
+    anything. A source is either a path, which is handed to the loader
+    (by default load_file()), or a (name, content) pair with content
+    being a string, a file-like object or an iterable of lines. Imports
+    are resolved through the loader. Errors and warnings are left in
+    the universe's diagnostics.
+    
+    The reports can then be obtained as objects, e.g. with options
+    from make_report_options():
+    
+        Statistics(identity).tally(options) -> TallyRows
+        Statistics(identity).check(options['time']) -> DayProblems
+        universe.workpackage_root.calc_activity(options['time']) -> ValueNode tree
+    
+    With lazy_text, descriptions and comments of plain files are only
+    read from the files when used (see Reader).
+    '''
+    universe = Universe()
+    reader = Reader(universe, loader=loader, verbose=False, lazy_text=lazy_text)
+    
+    for source in sources:
+        if isinstance(source, str):
+            reader.read(source)
+        else:
+            name, content = source
+            reader.read(name, content)
+    
+    return universe
+
+_report_jobs = ('tally-days', 'check-days', 'work-packages', 'show-work-packages', 'bill-of-materials',
+                'search', 'top', 'plan-vs-actual', 'verify-engine')
+
+class Snapshot:
+    '''A frozen view of a universe that has been read (and so tidied
+    up), to be queried by any number of threads at once without locks.
+    The snapshot takes the universe over: nothing may change it
+    afterwards, and none of the queries below does. Everything built
+    lazily elsewhere (e.g. the search index) is built up front.'''
+    __slots__ = ('_universe', '_search_index', 'people', 'files', 'messages', 'generation')
+    
+    def __init__(self, universe, generation=0):
+        universe.workpackage_root.tidy_up()
+        for name, value in (('_universe', universe), ('_search_index', universe.get_search_index()),
+                            ('people', tuple(universe.get_people())), ('files', tuple(universe.inputfiles)),
+                            ('messages', tuple(universe.diagnostics.messages)), ('generation', generation)):
+            object.__setattr__(self, name, value)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('snapshots cannot be changed')
+    
+    def __delattr__(self, name):
+        raise AttributeError('snapshots cannot be changed')
+    
+    def get_identity(self, name=None):
+        '''The identity of the given name (None: anonymous) or None.'''
+        return self._universe.identities.get(name)
+    
+    def get_workpackage(self, pathname):
+        return self._universe.get_workpackage(pathname)
+    
+    def tally(self, options, name=None):
+        '''The TallyRows of the time at work overview of an identity,
+        with options from make_report_options().'''
+        return list(Statistics(self.get_identity(name)).tally(options))
+    
+    def check(self, dayfilter, name=None):
+        '''The DayProblems of an identity's days passing the filter.'''
+        return list(Statistics(self.get_identity(name)).check(dayfilter))
+    
+    def activity(self, dayfilter, depth=None, min_value=0, activities=True, plan=False):
+        '''The ValueNode tree of WorkPackage.calc_activity().'''
+        return self._universe.workpackage_root.calc_activity(dayfilter, depth, min_value, activities, plan)
+    
+    def search(self, terms):
+        '''The search index entries containing all words of the terms.'''
+        return self._search_index.search(terms)
+    
+    def report(self, args):
+        '''Return the text of the reports given by command line options,
+        e.g. ['-t', '-f', '2012-07']. Only report jobs can be given, and
+        no input files. Raises ValueError for bad options. The texts of
+        -h, --version and --copyright are part of the returned text.'''
+        view = copy.copy(self._universe)
+        view.dump_options = dict(self._universe.dump_options)
+        view.diagnostics = Diagnostics()
+        app = Application(view)
+        
+        with output_to(io.StringIO()) as buf:
+            try:
+                app._parse_cmdline(['report'] + list(args))
+            except getopt.GetoptError as e:
+                raise ValueError(str(e))
+            if len(app._args) > 0:
+                raise ValueError('input files cannot be given in a snapshot report')
+            for job in app._jobs:
+                if job not in _report_jobs:
+                    raise ValueError('job ' + job + ' cannot be run on a snapshot')
+            if app._sqlite_import is not None or app._cache is not None:
+                raise ValueError('options --from-sqlite and --cache cannot be used on a snapshot')
+            app._workers = 1 # no forking in threads
+            app.process()
+        return buf.getvalue()
+
+class SnapshotPublisher:
+    '''Publishes Snapshots of the given sources (as for load_universe()).
+    New ones are built in background threads by refresh(); the attribute
+    current refers to the latest complete one, or None before the first
+    one is done. Readers simply take current and query it; replacing it
+    is a single reference assignment, so they see either the old or the
+    new snapshot, never a mix. Snapshots always hold their texts as
+    strings: text references (see load_universe()) would stop working
+    in the current snapshot as soon as a source file is changed.'''
+    def __init__(self, sources, loader=None):
+        self._sources = list(sources)
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.current = None
+    
+    def refresh(self, wait=False):
+        '''Start building a new snapshot in a background thread. Returns
+        the thread, after it has finished if wait is True. Snapshots
+        started earlier never replace ones started later.'''
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        
+        thread = threading.Thread(target=self._build, args=(generation,), daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+        return thread
+    
+    def _build(self, generation):
+        snapshot = Snapshot(load_universe(self._sources, self._loader), generation)
+        with self._lock:
+            if self.current is None or self.current.generation < generation:
+                self.current = snapshot
+
+_sqlite_schema = '''
+create table identities (id integer primary key, name text, fullname text);
+create table workpackages (id integer primary key, parent_id integer, name text not null,
+                           path text not null, description text, effort integer);
+create table days (id integer primary key, identity_id integer not null, date text not null,
+                   ordinal integer not null, weekday integer not null,
+                   start integer, stop integer, off integer, off_comment text,
+                   leave integer, leave_comment text, sick integer, sick_comment text,
+                   required integer not null, phol text);
+create table activities (id integer primary key, day_id integer not null,
+                         workpackage_id integer not null, seq integer not null,
+                         duration integer not null, description text);
+create table directives (id integer primary key, day_id integer not null, seq integer not null,
+                         reset integer not null, leave integer, must integer, have integer);
+create table comments (id integer primary key, day_id integer not null, seq integer not null,
+                       text text not null);
+create table files (seq integer primary key, name text not null);
+create index days_by_date on days (ordinal);
+create index days_by_identity on days (identity_id, ordinal);
+create index activities_by_day on activities (day_id);
+create index activities_by_workpackage on activities (workpackage_id, seq);
+create index workpackages_by_path on workpackages (path);
+'''
+
+def export_sqlite(universe, path):
+    '''Write the (tidied) universe into a new SQLite database. All
+    times are in minutes. Returns the number of days exported.'''
+    if os.path.exists(path):
+        os.remove(path)
+    
+    identities = []
+    wps = []
+    days = []
+    activities = []
+    directives = []
+    comments = []
+    wp_ids = {}
+    day_ids = {}
+    
+    for name, identity in universe.identities.items():
+        identities.append((len(identities) + 1, name, identity.fullname))
+        for day in identity.get_chrono_days():
+            day_id = len(days) + 1
+            day_ids[id(day)] = day_id
+            days.append((day_id, len(identities), str(day.date), day.date.toordinal(),
+                         day.date.weekday(), day.start, day.stop, day.off, day.off_comment,
+                         day.leave, day.leave_comment, day.sick, day.sick_comment,
+                         day.required, day.phol))
+            for seq, di in enumerate(day.directives or []):
+                directives.append((day_id, seq, di.reset, di.leave, di.must, di.have))
+            for seq, text in enumerate(day.comments or []):
+                comments.append((day_id, seq, text))
+    
+    stack = [ (universe.workpackage_root, None, '') ]
+    while len(stack) > 0:
+        wp, parent_id, wp_path = stack.pop()
+        wp_id = len(wps) + 1
+        wp_ids[id(wp)] = wp_id
+        wps.append((wp_id, parent_id, wp.name, wp_path, wp.description, wp.effort))
+        for seq, a in enumerate(wp.activities or []):
+            activities.append((day_ids[id(a.day())], wp_id, seq, a.duration, a.description))
+        for c in reversed(wp._children or []):
+            stack.append((c, wp_id, c.name if wp_path == '' else wp_path + '.' + c.name))
+    
+    with contextlib.closing(sqlite3.connect(path)) as con:
+        with con:
+            con.executescript(_sqlite_schema)
+            con.executemany('insert into identities values (?, ?, ?)', identities)
+            con.executemany('insert into workpackages values (?, ?, ?, ?, ?, ?)', wps)
+            con.executemany('insert into days values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', days)
+            con.executemany('insert into activities (day_id, workpackage_id, seq, duration, description) '
+                            'values (?, ?, ?, ?, ?)', activities)
+            con.executemany('insert into directives (day_id, seq, reset, leave, must, have) '
+                            'values (?, ?, ?, ?, ?, ?)', directives)
+            con.executemany('insert into comments (day_id, seq, text) values (?, ?, ?)', comments)
+            con.executemany('insert into files (name) values (?)', [ (f,) for f in universe.inputfiles ])
+    
+    return len(days)
+
+_sqlite_day_columns = 'd.id, d.identity_id, d.ordinal, d.start, d.stop, d.off, d.off_comment, '\
+                      'd.leave, d.leave_comment, d.sick, d.sick_comment, d.required, d.phol'
+
+def load_sqlite(path, universe=None, dayfilter=None):
+    '''Fill a universe from a database written by export_sqlite().
+    Activities, directives and comments are only loaded for the days
+    within the filter's ordinal range. Days outside the range are
+    skipped, except for the last one before it and the first one
+    after it of each person, so that the gaps and the reports come
+    out the same as from the log files. Returns the universe.'''
+    if universe is None:
+        universe = Universe()
+    
+    bounds = None if dayfilter is None else dayfilter.ordinal_range()
+    if bounds is None:
+        in_range, params = '', ()
+    else:
+        in_range, params = ' where d.ordinal between ? and ?', bounds
+    
+    with contextlib.closing(sqlite3.connect(path)) as con:
+        identities = {}
+        for identity_id, name, fullname in con.execute('select id, name, fullname from identities'):
+            identities[identity_id] = universe.get_identity(name, fullname)
+        
+        wps = {}
+        for wp_id, parent_id, name, description, effort in \
+                con.execute('select id, parent_id, name, description, effort from workpackages order by id'):
+            if parent_id is None:
+                wp = universe.workpackage_root
+            else:
+                wp = WorkPackage(name, description)
+                wps[parent_id].add_child(wp)
+            wp.effort = effort
+            wps[wp_id] = wp
+        
+        rows = con.execute('select ' + _sqlite_day_columns + ' from days d' + in_range,
+                           params).fetchall()
+        if bounds is not None:
+            neighbours = con.execute('select identity_id, max(ordinal) from days where ordinal < ? '
+                                     'group by identity_id', bounds[:1]).fetchall()
+            neighbours += con.execute('select identity_id, min(ordinal) from days where ordinal > ? '
+                                      'group by identity_id', bounds[1:]).fetchall()
+            for identity_id, ordinal in neighbours:
+                rows += con.execute('select ' + _sqlite_day_columns + ' from days d '
+                                    'where d.identity_id = ? and d.ordinal = ?', (identity_id, ordinal))
+        
+        days = {}
+        for row in rows:
+            day = Day(date.fromordinal(row[2]))
+            day.start, day.stop, day.off, day.off_comment = row[3:7]
+            day.leave, day.leave_comment, day.sick, day.sick_comment = row[7:11]
+            day.required, day.phol = row[11:13]
+            identities[row[1]].days[str(day.date)] = day
+            days[row[0]] = day
+        
+        for day_id, reset, leave, must, have in \
+                con.execute('select r.day_id, r.reset, r.leave, r.must, r.have from directives r '
+                            'join days d on d.id = r.day_id' + in_range + ' order by r.day_id, r.seq', params):
+            di = Directive().set_leave(leave).set_must(must).set_have(have)
+            if reset:
+                di.set_reset()
+            days[day_id].add_directive(di)
+        
+        for day_id, text in con.execute('select c.day_id, c.text from comments c join days d '
+                                        'on d.id = c.day_id' + in_range + ' order by c.day_id, c.seq', params):
+            days[day_id].add_comment(text)
+        
+        for day_id, wp_id, duration, description in \
+                con.execute('select a.day_id, a.workpackage_id, a.duration, a.description from activities a '
+                            'join days d on d.id = a.day_id' + in_range + ' order by a.workpackage_id, a.seq', params):
+            activity = Activity(duration, description)
+            activity.attach_to(wps[wp_id])
+            activity.attach_to(days[day_id])
+        
+        for (name,) in con.execute('select name from files order by seq'):
+            universe.add_file(name)
+    
+    for identity in universe.identities.values():
+        identity.day_index = DayIndex(identity.days.values())
+    
+    return universe
 
-                if do_daily and (d.calc_have() > 0.0 or d.is_workday()):
-                    d.dump(options)
+_archive_magic = b'TFARCH1\n'
+_archive_extension = '.tfa'
 
-                self.prev_day = d
-                self.prev_week = this_week
-                self.prev_month = this_month
+def is_archive(path):
+    '''Return True if the path names an archive (possibly compressed).'''
+    root, ext = os.path.splitext(path)
+    if ext in _decompressors:
+        ext = os.path.splitext(root)[1]
+    return ext == _archive_extension
+_archive_day_fields = 12 # ordinal, identity, start, stop, off, leave, sick,
+                         # flags, phol, off, leave and sick comments
+_archive_leave_all_day = 1
+_archive_sick_all_day = 2
 
-        if do_weekly:
-            self.weekly.dump(self.prev_week)
-        if do_monthly:
-            self.monthly.dump(self.prev_month)
-        self.totals.dump(None)
+def compile_archive(universe, path, dayfilter=None, text=True):
+    '''Write the days passing the filter, their activities, directives
+    and comments and the work package tree of the (tidied) universe into
+    a compact binary archive which can be imported in place of the log
+    files. The numbers go into integer arrays, None being stored as -1;
+    names and texts go into a JSON header. Without text the activity
+    descriptions and day comments are left out. Returns the number of
+    days archived.'''
+    strings = {}
+    def string_id(text):
+        return -1 if text is None else strings.setdefault(text, len(strings))
+    
+    def value(v):
+        return -1 if v is None else v
+    
+    identities = []
+    days = array.array('i')
+    day_ids = {}
+    musthours = {}
+    directives = {}
+    comments = array.array('i')
+    
+    for name, identity in universe.identities.items():
+        identities.append((name, identity.fullname))
+        must_hours = universe.musthours if identity.musthours is None else identity.musthours
+        first = True
         
-        dump_day_header()
+        for day in identity.get_chrono_days():
+            if day.musthours is not None:
+                must_hours = day.musthours
+            if dayfilter is not None and not dayfilter.passes(day):
+                continue
+            
+            day_id = len(day_ids)
+            day_ids[id(day)] = day_id
+            if first or day.musthours is not None:
+                # The must hours in effect on the first day make the
+                # archive independent of the must hours of the importer.
+                musthours[day_id] = must_hours
+                first = False
+            
+            flags = (_archive_leave_all_day if day.leave_all_day else 0) |\
+                    (_archive_sick_all_day if day.sick_all_day else 0)
+            days.extend((day.date.toordinal(), len(identities) - 1, value(day.start), value(day.stop),
+                         day.off, day.leave, day.sick, flags, string_id(day.phol),
+                         string_id(day.off_comment), string_id(day.leave_comment),
+                         string_id(day.sick_comment)))
+            
+            if day.directives is not None:
+                directives[day_id] = [ (di.reset, di.leave, di.must, di.have) for di in day.directives ]
+            if text:
+                for cmnt in day.comments or ():
+                    comments.extend((day_id, string_id(cmnt)))
+    
+    wps = []
+    activities = array.array('i')
+    stack = [ (c, c.name) for c in reversed(universe.workpackage_root._children or []) ]
+    while len(stack) > 0:
+        wp, wp_path = stack.pop()
+        wps.append((wp_path, wp.effort, wp.description))
+        for a in wp.activities or ():
+            day_id = day_ids.get(id(a.day()))
+            if day_id is not None:
+                desc = string_id(a.description) if text else -1
+                activities.extend((day_id, len(wps) - 1, a.duration, desc))
+        for c in reversed(wp._children or []):
+            stack.append((c, wp_path + '.' + c.name))
+    
+    header = json.dumps({ 'byteorder':sys.byteorder, 'identities':identities, 'workpackages':wps,
+                          'strings':list(strings), 'musthours':musthours, 'directives':directives,
+                          'days':len(day_ids), 'comments':len(comments) // 2,
+                          'activities':len(activities) // 4 }).encode('utf-8')
+    
+    with _decompressors.get(os.path.splitext(path)[1], open)(path, 'wb') as f:
+        f.write(_archive_magic)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for arr in days, comments, activities:
+            if sys.byteorder != 'little':
+                arr.byteswap()
+            arr.tofile(f)
+    
+    return len(day_ids)
+
+def read_archive(f):
+    '''Read an archive written by compile_archive() from the binary file
+    f. Returns the header and the day, comment and activity arrays.
+    Raises ValueError if the archive is malformed.'''
+    if f.read(len(_archive_magic)) != _archive_magic:
+        raise ValueError('not a TimeFlies archive')
+    try:
+        size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(size).decode('utf-8'))
+        
+        arrays = []
+        for count, fields in (header['days'], _archive_day_fields), (header['comments'], 2), \
+                             (header['activities'], 4):
+            arr = array.array('i')
+            arr.fromfile(f, count * fields)
+            if sys.byteorder != 'little':
+                arr.byteswap()
+            arrays.append(arr)
+    except (struct.error, EOFError, KeyError, UnicodeDecodeError) as e:
+        raise ValueError('truncated or bad archive; ' + str(e))
+    return [header] + arrays
+
+def load_archive(f, universe):
+    '''Add the content of an archive written by compile_archive(), read
+    from the binary file f, to the universe. Days already present in
+    the universe are left as they are. Returns the date strings of
+    those days. Raises ValueError if the archive is malformed.'''
+    header, days, comments, activities = read_archive(f)
+    strings = header['strings']
+    
+    def string(i):
+        return None if i < 0 else strings[i]
+    
+    def value(v):
+        return None if v < 0 else v
+    
+    identities = [ universe.get_identity(name, fullname) for name, fullname in header['identities'] ]
+    
+    wps = []
+    for path, effort, description in header['workpackages']:
+        wp = universe.workpackage_root.get_node(path, create=True)
+        if effort:
+            wp.effort = effort
+        if description is not None:
+            wp.description = description
+        wps.append(wp)
+    
+    musthours = header['musthours']
+    directives = header['directives']
+    loaded = []
+    skipped = []
+    for day_id in range(header['days']):
+        (ordinal, identity, start, stop, off, leave, sick, flags, phol,
+         off_comment, leave_comment, sick_comment) = \
+            days[day_id * _archive_day_fields:(day_id + 1) * _archive_day_fields]
+        
+        day = Day(date.fromordinal(ordinal))
+        key = str(day.date)
+        if key in identities[identity].days:
+            skipped.append(key)
+            loaded.append(None)
+            continue
+        
+        day.start, day.stop, day.off, day.leave, day.sick = value(start), value(stop), off, leave, sick
+        day.leave_all_day = (flags & _archive_leave_all_day) != 0
+        day.sick_all_day = (flags & _archive_sick_all_day) != 0
+        day.phol, day.off_comment = string(phol), string(off_comment)
+        day.leave_comment, day.sick_comment = string(leave_comment), string(sick_comment)
+        day.musthours = musthours.get(str(day_id))
+        for reset, di_leave, must, have in directives.get(str(day_id), ()):
+            di = Directive().set_leave(di_leave).set_must(must).set_have(have)
+            if reset:
+                di.set_reset()
+            day.add_directive(di)
+        
+        identities[identity].days[key] = day
+        loaded.append(day)
+    
+    for i in range(0, len(comments), 2):
+        day = loaded[comments[i]]
+        if day is not None:
+            day.add_comment(strings[comments[i + 1]])
+    
+    for i in range(0, len(activities), 4):
+        day = loaded[activities[i]]
+        if day is not None:
+            activity = Activity(activities[i + 2], string(activities[i + 3]))
+            activity.attach_to(day)
+            activity.attach_to(wps[activities[i + 1]])
+    
+    return skipped
+
+def hash_file(path):
+    '''Return the SHA-256 hex digest of the file's content, or None if
+    the file cannot be read.'''
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+    except IOError:
+        return None
+    return h.hexdigest()
+
+class ReportCache:
+    '''A directory of report outputs. An entry is found by a key made
+    from the command line; it is only used if none of the files that
+    went into it (including ones that could not be opened) changed.
+    The least recently used entries are removed when the total size
+    of the entries goes beyond the limit (in bytes).'''
+    def __init__(self, folder, limit=10 << 20):
+        self.folder = folder
+        self.limit = limit
+    
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.json')
+    
+    def make_key(self, settings):
+        text = json.dumps([_version, os.getcwd(), settings], sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+    
+    def lookup(self, key):
+        '''Return the report stored under the key if it is still valid,
+        None otherwise.'''
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        
+        for file, digest in entry['files']:
+            if hash_file(file) != digest:
+                return None
+        
+        os.utime(path)
+        return entry['report']
+    
+    def store(self, key, files, report):
+        entry = { 'files':[ (f, hash_file(f)) for f in sorted(files) ], 'report':report }
+        os.makedirs(self.folder, exist_ok=True)
+        path = self._path(key)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(path + '.tmp', path)
+        self._evict()
+    
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.folder):
+            if name.endswith('.json'):
+                st = os.stat(os.path.join(self.folder, name))
+                entries.append((st.st_mtime, st.st_size, name))
+                total += st.st_size
+        
+        entries.sort()
+        while total > self.limit and len(entries) > 0:
+            mtime, size, name = entries.pop(0)
+            os.remove(os.path.join(self.folder, name))
+            total -= size
+
+_batch_application = None
+
+def _run_query(query):
+    '''Run one query of a batch file against _batch_application. This
+    runs in a worker process forked after the input has been read when
+    there is more than one worker. Returns an error message or None.'''
+    return _batch_application.run_query(*query)
 
 class Application:
-    def __init__(self):
-        self._universe = Universe()
+    def __init__(self, universe=None):
+        self._universe = Universe() if universe is None else universe
         self._jobs = []
         self._filter = 'all'
         self._args = None
+        self._workers = 1
+        self._sqlite_export = None
+        self._sqlite_import = None
+        self._cache = None
+        self._cache_size = 10 << 20
+        self._cache_key = None
+        self._saved_dest = None
+        self._batch = None
+        self._archive = None
+        self._archive_text = True
+        self._linted = 0
+        self._lazy_text = False
+        self._chunk_days = None
+        self._engine_name = 'reference'
     
     def _set_dump_option(self, key, value):
         self._dump_options()[key] = value
@@ -1081,102 +3806,434 @@ class Application:
     
     def interpret_cmdline(self, argv):
         try:
-            opts, self._args = getopt.getopt(argv[1:], 'hf:tcwsaCi:b',
-                                       ['help', 'version', 'copyright', 'filter=',
-                                        'tally-days', 'check-days',
-                                        'work-packages', 'show-work-packages',
-                                        'activities', 'comments',
-                                        'indent=', 'bill-of-materials'])
-    
-            for opt, val in opts:
-                if opt == '-h' or opt == '--help':
-                    self.show_usage(argv[0])
-                elif opt == '--copyright':
-                    output(_copyright.format(_version))
-                elif opt == '--version':
-                    output(_version)
-                elif opt == '-f' or opt == '--filter':
-                    self._filter = val
-                elif opt == '-t' or opt == '--tally-days':
-                    self._jobs.append('tally-days')
-                elif opt == '-c' or opt == '--check-days':
-                    self._jobs.append('check-days')
-                elif opt == '-w' or opt == '--work-packages':
-                    self._jobs.append('work-packages')
-                elif opt == '-s' or opt == '--show-work-packages':
-                    self._jobs.append('show-work-packages')
-                elif opt == '-b' or opt == '--bill-of-materials':
-                    self._jobs.append('bill-of-materials')
-                elif opt == '-a' or opt == '--activities':
-                    self._set_dump_option('activities', True)
-                elif opt == '-C' or opt == '--comments':
-                    self._set_dump_option('comments', True)
-                elif opt == '-i' or opt == '--indent':
-                    self._set_dump_option('indent', ' ' * int(val))
-    
+            self._parse_cmdline(argv)
         except getopt.GetoptError as e:
             output(argv[0] + ': ' + str(e))
             output('For help try: ' + argv[0] + ' --help')
             exit()
+    
+    def _parse_cmdline(self, argv):
+        opts, self._args = getopt.getopt(argv[1:], 'hf:tcwsaCi:bj:',
+                                   ['help', 'version', 'copyright', 'filter=',
+                                    'tally-days', 'check-days',
+                                    'work-packages', 'show-work-packages',
+                                    'activities', 'comments',
+                                    'indent=', 'bill-of-materials',
+                                    'message-format=', 'message-limit=',
+                                    'workers=', 'export-sqlite=', 'from-sqlite=',
+                                    'depth=', 'min-hours=', 'top=', 'subtrees',
+                                    'plan-vs-actual', 'rolling=', 'search=',
+                                    'cache=', 'cache-size=', 'batch=',
+                                    'compile-archive=', 'no-archive-text',
+                                    'check-incremental', 'lint', 'lazy-text', 'chunk-days=',
+                                    'engine=', 'verify-engine'])
+
+        for opt, val in opts:
+            if opt == '-h' or opt == '--help':
+                self.show_usage(argv[0])
+            elif opt == '--copyright':
+                output(_copyright.format(_version))
+            elif opt == '--version':
+                output(_version)
+            elif opt == '-f' or opt == '--filter':
+                self._filter = val
+            elif opt == '-t' or opt == '--tally-days':
+                self._jobs.append('tally-days')
+            elif opt == '-c' or opt == '--check-days':
+                self._jobs.append('check-days')
+            elif opt == '-w' or opt == '--work-packages':
+                self._jobs.append('work-packages')
+            elif opt == '-s' or opt == '--show-work-packages':
+                self._jobs.append('show-work-packages')
+            elif opt == '-b' or opt == '--bill-of-materials':
+                self._jobs.append('bill-of-materials')
+            elif opt == '-a' or opt == '--activities':
+                self._set_dump_option('activities', True)
+            elif opt == '-C' or opt == '--comments':
+                self._set_dump_option('comments', True)
+            elif opt == '-i' or opt == '--indent':
+                self._set_dump_option('indent', ' ' * int(val))
+            elif opt == '--message-format':
+                if val != 'text' and val != 'json':
+                    raise getopt.GetoptError('bad message format ' + val)
+                self._universe.diagnostics.format = val
+            elif opt == '--message-limit':
+                self._universe.diagnostics.limit = self._count_option(opt, val, 0)
+            elif opt == '-j' or opt == '--workers':
+                self._workers = self._count_option(opt, val, 1)
+            elif opt == '--depth':
+                self._set_dump_option('depth', self._count_option(opt, val, 0))
+            elif opt == '--min-hours':
+                minutes = make_time(val)
+                if minutes is None:
+                    raise getopt.GetoptError('bad time ' + val + ' for option --min-hours')
+                self._set_dump_option('min-value', minutes)
+            elif opt == '--search':
+                self._jobs.append('search')
+                self._set_dump_option('search', val)
+            elif opt == '--rolling':
+                window = make_window(val)
+                if window is None:
+                    raise getopt.GetoptError('bad window ' + val + ' for option --rolling')
+                self._set_dump_option('rolling', window)
+            elif opt == '--plan-vs-actual':
+                self._jobs.append('plan-vs-actual')
+            elif opt == '--top':
+                self._jobs.append('top')
+                self._set_dump_option('top', self._count_option(opt, val, 1))
+            elif opt == '--subtrees':
+                self._set_dump_option('subtrees', True)
+            elif opt == '--export-sqlite':
+                self._jobs.append('export-sqlite')
+                self._sqlite_export = val
+            elif opt == '--from-sqlite':
+                self._sqlite_import = val
+            elif opt == '--cache':
+                self._cache = ReportCache(val, self._cache_size)
+            elif opt == '--cache-size':
+                self._cache_size = self._count_option(opt, val, 0) << 20
+                if self._cache is not None:
+                    self._cache.limit = self._cache_size
+            elif opt == '--batch':
+                self._jobs.append('batch')
+                self._batch = val
+            elif opt == '--compile-archive':
+                self._jobs.append('compile-archive')
+                self._archive = val
+            elif opt == '--no-archive-text':
+                self._archive_text = False
+            elif opt == '--check-incremental':
+                self._jobs.append('check-incremental')
+            elif opt == '--lint':
+                self._jobs.append('lint')
+            elif opt == '--lazy-text':
+                self._lazy_text = True
+            elif opt == '--engine':
+                if val not in _engines:
+                    raise getopt.GetoptError('unknown engine ' + val)
+                self._engine_name = val
+            elif opt == '--verify-engine':
+                self._jobs.append('verify-engine')
+            elif opt == '--chunk-days':
+                self._chunk_days = self._count_option(opt, val, 1)
+        
+        if self._sqlite_import is not None and len(self._args) > 0:
+            raise getopt.GetoptError('input files cannot be given with option --from-sqlite')
+    
+    def _count_option(self, opt, val, minimum):
+        '''Return the value of a numeric option, which must be a whole
+        number of at least minimum.'''
+        try:
+            count = int(val)
+        except ValueError:
+            count = None
+        if count is None or count < minimum:
+            raise getopt.GetoptError('bad count ' + val + ' for option ' + opt)
+        return count
+    
+    def _cache_settings(self):
+        '''Everything from the command line that has a say in the
+        output, or None if the output cannot be cached.'''
+        if '-' in self._args or any(j in self._jobs for j in ('export-sqlite', 'compile-archive', 'batch')):
+            return None
+        
+        options = {}
+        for key, value in self._dump_options().items():
+            if key != 'time':
+                options[key] = value
+        
+        return { 'jobs':self._jobs, 'filter':self._filter, 'args':self._args,
+                 'sqlite':self._sqlite_import, 'engine':self._engine_name, 'options':options,
+                 'messages':[ self._universe.diagnostics.format, self._universe.diagnostics.limit ] }
+    
+    def replay_cached(self):
+        '''If a cache is used and holds a valid report for this command
+        line, print that and return True. Otherwise start capturing
+        the output for the cache and return False.'''
+        if self._cache is None:
+            return False
+        
+        settings = self._cache_settings()
+        if settings is None:
+            return False
+        
+        self._cache_key = self._cache.make_key(settings)
+        report = self._cache.lookup(self._cache_key)
+        if report is not None:
+            output(report, end='')
+            return True
+        
+        self._saved_dest = _outputdest
+        set_output_destination(io.StringIO())
+        return False
+    
+    def cache_result(self, store=True):
+        '''Print the captured output and, if store is True, keep it in
+        the cache. Failing to write the cache only gives a warning.'''
+        if self._saved_dest is None:
+            return
+        
+        report = _outputdest.getvalue()
+        set_output_destination(self._saved_dest)
+        self._saved_dest = None
+        output(report, end='')
+        if not store:
+            return
+        
+        files = set(self._universe.inputfileset)
+        if self._sqlite_import is not None:
+            files.add(os.path.abspath(self._sqlite_import))
+        try:
+            self._cache.store(self._cache_key, files, report)
+        except OSError as e:
+            output('WARNING : failed to write the report cache; ' + str(e) + '.')
         
     def read_files(self):
-        r = Reader(self._universe)
+        if 'lint' in self._jobs:
+            self._linted = lint_files(self._universe, self._args, self._workers)
+            return
+        
+        if self._sqlite_import is not None:
+            options = make_report_options(self._filter)[0]
+            load_sqlite(self._sqlite_import, self._universe, options['time'])
+            return
+        
+        # the messages of all inputs are output together at the end
+        r = Reader(self._universe, verbose=False, lazy_text=self._lazy_text)
         for f in self._args:
             r.read(f)
+        self._universe.diagnostics.flush()
     
     def _process_filter(self):
-        stats_day = False
-        stats_week = False
-        stats_month = False
-        
-        for flt in self._filter.split(','):
-            if flt == 'day':
-                stats_day = True
-            elif flt == 'week':
-                stats_week = True
-            elif flt == 'month':
-                stats_month = True
-            else:
-                tf = make_filter(flt)
-                if tf is not None:
-                    self._set_dump_option('time', tf)
-        
-        if not 'time' in self._dump_options():
-            self._set_dump_option('time', make_filter('all'))
-            
-        if not stats_week and not stats_month:
-            for kind in ['day', 'week', 'month']:
-                self._set_dump_option(kind, True)
-        else:
-            self._set_dump_option('day', stats_day)
-            self._set_dump_option('week', stats_week)
-            self._set_dump_option('month', stats_month)
+        options, bad = make_report_options(self._filter, self._dump_options())
+        for flt in bad:
+            output('Bad time filter argument: ' + flt)
             
         self._filter = ", ".join(self._filter.split(','))
         
     def process(self):
+        if 'lint' in self._jobs:
+            output(plural(self._linted, 'file') + ' checked.')
+            return
+        
         self._process_filter()
         
         for j in self._jobs:
             if j == 'check-days':
                 output('Day check (' + self._filter + '):')
-                Statistics(self._universe).check_days(self._get_dump_option('time'))
+                if self._universe.is_team():
+                    for person in self._universe.get_people():
+                        output(person.label() + ':')
+                        dump_problems(self._engine().check(person, self._get_dump_option('time')))
+                else:
+                    dump_problems(self._engine().check(self._universe.anonymous, self._get_dump_option('time')))
             elif j == 'work-packages':
                 output('Work package summary (' + self._filter + '):')
-                act = self._universe.workpackage_root.calc_activity(self._get_dump_option('time'))
-                act.dump(self._dump_options())
+                options = self._dump_options()
+                act = self._engine().activity(self._universe.workpackage_root, options)
+                act.dump(options)
+            elif j == 'plan-vs-actual':
+                output('Plan vs. actual (' + self._filter + '):')
+                output('   plan  actual  remain  used   /week : work package')
+                options = dict(self._dump_options(), plan=True)
+                options['weeks'] = period_weeks(self._universe, options['time'])
+                act = self._engine().activity(self._universe.workpackage_root, options, True)
+                act.dump(options)
+            elif j == 'search':
+                self._search(self._get_dump_option('search'), self._get_dump_option('time'))
+            elif j == 'top':
+                options = self._dump_options()
+                toplist = TopList(options['top'])
+                self._universe.workpackage_root.rank_activity(options['time'], toplist,
+                                                              'subtrees' in options)
+                output('Top ' + plural(options['top'], 'work package') + ' (' + self._filter + '):')
+                for value, (path, wp) in toplist.items():
+                    desc = '' if wp.description is None else '; ' + wp.description
+                    output('{0:7.2f} : {1:s}{2:s}'.format(hours(value), path, desc))
+            elif j == 'verify-engine':
+                self._verify_engine()
             elif j == 'tally-days':
                 output('Time at work overview (' + self._filter + '):')
-                Statistics(self._universe).calc_balance(self._dump_options())
+                if self._universe.is_team():
+                    tally_team(self._universe, self._dump_options(), self._workers)
+                else:
+                    dump_tally(self._engine().tally(self._universe.anonymous, self._dump_options()),
+                               self._dump_options())
             elif j == 'show-work-packages':
                 output('Work package breakdown:')
                 self._universe.workpackage_root.dump(self._dump_options())
             elif j == 'bill-of-materials':
                 output('Bill of materials:')
                 self._universe.bill_of_materials()
+            elif j == 'batch':
+                self._run_batch()
+            elif j == 'check-incremental':
+                self._check_incremental(self._get_dump_option('time'))
+            elif j == 'compile-archive':
+                days = compile_archive(self._universe, self._archive, self._get_dump_option('time'),
+                                       self._archive_text)
+                output('Compiled ' + plural(days, 'day') + ' into ' + self._archive + '.')
+            elif j == 'export-sqlite':
+                days = export_sqlite(self._universe, self._sqlite_export)
+                output('Exported ' + plural(days, 'day') + ' to ' + self._sqlite_export + '.')
             else:
                 output('*** Unknown job: ' + j)
 
+    def _engine(self):
+        return _engines[self._engine_name](self._universe, self._chunk_days, self._workers)
+    
+    def _verify_engine(self):
+        '''Compare the reports of the selected engine with those of the
+        reference engine.'''
+        engine = self._engine()
+        output('Engine check (' + engine.name + ' against reference, ' + self._filter + '):')
+        differences = 0
+        for title, lines, difference in verify_engine(engine, self._dump_options()):
+            if difference is None:
+                output(title + ': ' + plural(lines, 'line') + ' the same')
+            else:
+                line, want, have = difference
+                output(title + ': line ' + str(line) + ' differs')
+                width = max(len('reference'), len(engine.name))
+                output('  ' + 'reference'.ljust(width) + ': ' + ('(no line)' if want is None else want))
+                output('  ' + engine.name.ljust(width) + ': ' + ('(no line)' if have is None else have))
+                differences += 1
+        
+        if differences != 0:
+            output(plural(differences, 'report') + ' differ.')
+        else:
+            output('ok.')
+    
+    def _check_incremental(self, dayfilter):
+        '''Take the days passing the filter out of the maintained totals
+        and put them back, and compare the result with a full recompute.'''
+        output('Incremental totals check (' + self._filter + '):')
+        rollups = Rollups(self._universe)
+        
+        def put_back(identity, day):
+            for a in day.activities or ():
+                a.attach_to(a.workpackage())
+            rollups.add_day(identity, day)
+        
+        replaced = removed = 0
+        for identity in list(self._universe.identities.values()):
+            days = [ d for d in identity.get_chrono_days() if dayfilter.passes(d) ]
+            for day in days:
+                put_back(identity, rollups.remove_day(identity, str(day.date)))
+                replaced += 1
+            
+            taken = [ rollups.remove_day(identity, str(d.date)) for d in days[::2] ]
+            removed += len(taken)
+            for day in reversed(taken):
+                put_back(identity, day)
+        
+        output(plural(replaced, 'day') + ' replaced, ' + str(removed) + ' removed and added again.')
+        problems = rollups.check()
+        for problem in problems:
+            output(problem)
+        if len(problems) == 0:
+            output('No differences to a full recompute.')
+        else:
+            output(plural(len(problems), 'difference') + ' found.')
+    
+    def _read_batch(self):
+        '''Return the queries in the batch file as tuples (line number,
+        output file, options). Empty lines and '#' comments are skipped.'''
+        queries = []
+        with open(self._batch, encoding='utf-8') as f:
+            for lineno, line in enumerate(f, 1):
+                words = shlex.split(line, comments=True)
+                if len(words) > 0:
+                    queries.append((lineno, words[0], words[1:]))
+        return queries
+    
+    def _run_batch(self):
+        global _batch_application
+        try:
+            queries = self._read_batch()
+        except (IOError, ValueError) as e:
+            output('Cannot read batch file ' + self._batch + ': ' + str(e))
+            return
+        
+        output('Batch ' + self._batch + ':')
+        parallel = (self._workers > 1 and len(queries) > 1 and
+                    'fork' in multiprocessing.get_all_start_methods())
+        jobs = [ q + (parallel,) for q in queries ]
+        
+        _batch_application = self
+        try:
+            if parallel:
+                with multiprocessing.get_context('fork').Pool(self._workers) as pool:
+                    errors = pool.map(_run_query, jobs)
+            else:
+                errors = [ _run_query(j) for j in jobs ]
+        finally:
+            _batch_application = None
+        
+        failed = 0
+        for (lineno, outfile, args), error in zip(queries, errors):
+            if error is None:
+                output(outfile)
+            else:
+                output(self._batch + ':' + str(lineno) + ': ERROR : ' + error)
+                failed += 1
+        
+        output(plural(len(queries) - failed, 'report') + ' written.')
+    
+    def run_query(self, lineno, outfile, args, parallel=False):
+        '''Run the jobs given by the options in args against the input
+        read already and write the output to outfile. The options of
+        this application (e.g. -a or -i) apply unless overridden.
+        Returns an error message or None.'''
+        saved_options = self._universe.dump_options
+        self._universe.dump_options = { k:v for k, v in saved_options.items() if k != 'time' }
+        query = Application(self._universe)
+        try:
+            query._parse_cmdline(['batch'] + args)
+            if len(query._args) > 0:
+                return 'input files cannot be given in a batch query'
+            if query._batch is not None or query._sqlite_export is not None or query._archive is not None:
+                return 'options --batch, --export-sqlite and --compile-archive cannot be used in a batch query'
+            if parallel:
+                query._workers = 1
+            
+            with open(outfile, 'w', encoding='utf-8') as f, output_to(f):
+                query.process()
+        except (getopt.GetoptError, ValueError, IOError) as e:
+            return str(e)
+        finally:
+            self._universe.dump_options = saved_options
+        
+        return None
+    
+    def _search(self, terms, dayfilter):
+        output('Search for "' + terms + '" (' + self._filter + '):')
+        totals = {}
+        activities = 0
+        comments = 0
+        found = [ e for e in self._universe.get_search_index().search(terms)
+                  if dayfilter.passes(e[0] if isinstance(e, tuple) else e.day()) ]
+        found.sort(key=lambda e: (e[0] if isinstance(e, tuple) else e.day()).date)
+        
+        for entry in found:
+            if isinstance(entry, tuple):
+                day, comment = entry
+                output(format_date(day.date) + ' ; ' + comment)
+                comments += 1
+            else:
+                path = entry.workpackage().get_path()
+                output(format_date(entry.day().date) + ' {0:7.2f} : {1:s}; {2:s}'
+                       .format(hours(entry.duration), path, entry.description))
+                totals[path] = totals.get(path, 0) + entry.duration
+                activities += 1
+        
+        if len(totals) > 0:
+            output('Hours per work package:')
+            for path in sorted(totals):
+                output('{0:7.2f} : {1:s}'.format(hours(totals[path]), path))
+        
+        output(plural(activities, 'activit', 'ies', 'y') + ' and ' + plural(comments, 'comment') + ' found.')
+
     def show_usage(self, cmd):
         output()
         output('  Usage: ' + cmd + ' [options] <infile> [..]')
@@ -1186,6 +4243,8 @@ class Application:
       This is a simple time log and work package tree processor. Projects can be
       defined in form of hierarchical work package trees. Daily work progress is logged
       in form of day records with attached activities referring to work packages.
+      Input files ending in .csv or .tsv hold one activity per row with the
+      columns date, start, stop, work package, duration and comment.
     
       This program comes with ABSOLUTELY NO WARRANTY. This is free software,
       and you are welcome to redistribute it under certain conditions. You
@@ -1199,24 +4258,100 @@ class Application:
       --copyright : show copyright info
       -b, --bill-of-materials : list all input files processed; can be used
           to get an overview of all imported files
-      -f, --filter <filter> : a filter to select a processing time range;
-          YYYY-MM selects a month; YYYY-MM-DD..YYYY-MM-DD selects a time range
-          by giving the first and last day; 'all' to process all days;
+      -f, --filter <filter> : a filter to select the days to process;
+          YYYY selects a year, YYYY-Qn a quarter, YYYY-MM a month and
+          YYYY-MM-DD a day; <first>..<last> of these selects a time range,
+          like 2012-07-14..2012-08-01 or 2012-03..2012-Q3; 'all' to process
+          all days; the days of several of these items add up; mon, ..., sun
+          and ranges like mon..fri select weekdays; phol selects public
+          holidays; an item with a leading '-' excludes its days instead,
+          like -2012-12-24..2012-12-31, -sat or -phol;
           for option -t summary cycles of 'day', 'week' and 'month' (or
           combinations thereof) can be added with the filter option too;
           to combine multiple items, use a comma separated list;
           default: process all
       -t, --tally-days : calculate the total must/have/leave/sick
           work hour balance
+      --rolling <window> : in option -t, add the weekly averages of the hours
+          worked and of the balance over the last <window> to each line;
+          <window> is a number of days, or of weeks when followed by 'w'
       -c, --check-days : check the daily work time vs. booked
           work package time; helps to find unaccounted for time at work
       -w, --work-packages : calculate hours worked on work packages
+      --plan-vs-actual : compare the effort estimates of the work packages
+          with the hours worked on them: estimate, hours worked, remaining
+          hours, the percentage of the estimate used and the hours worked
+          per week from the first to the last day passing the filter
+      --depth <levels> : in options -w and --plan-vs-actual, show no more
+          than <levels> levels of work packages; deeper levels count for
+          their parent packages
+      --min-hours <time> : in options -w and --plan-vs-actual, leave out
+          work packages with less time; their time and activities are
+          shown as the _self part of their parent packages
+      --top <count> : list the <count> work packages with the most time
+          booked directly on them
+      --subtrees : in option --top, rank work packages by the time booked on
+          them and on all their sub-packages
+      --search <words> : list the activities and day comments containing
+          all of the given words, with the hours per work package
       -s, --show-work-packages : show the work package tree
       -a, --activities : show activities in work package tree output (in options
           -w, -s or -t)
       -C, --comments : show log comments for each day (in option -t)
+      --lazy-text : keep activity descriptions and day comments of plain log
+          files as positions in the files while reading and only read them
+          again where they are printed or searched; saves memory
+      --cache <folder> : keep the output in the cache <folder> and print it
+          from there as long as the command line and the input files do
+          not change
+      --cache-size <megabytes> : remove the least recently used outputs from
+          the cache when it grows beyond this size; default: 10
+      --batch <file> : run many reports on the input read once; each line in
+          <file> names an output file followed by the options for its report
+          (like -t, -w, -c, -f <filter>); with -j the reports are written by
+          parallel worker processes
       -i, --indent <width> : indent each level in the work package hierarchy by
           <width> space characters; default: 4
+      --message-format <format> : print error and warning messages found
+          while reading the input as 'text' or 'json' (one document on
+          standard error); default: text
+      --message-limit <count> : show no more than <count> messages about a
+          file; the others are only counted; 0 means no limit; default: 100
+      -j, --workers <count> : number of worker processes used to tally the
+          days of a team (logs using the 'identity' instruction), to run
+          the reports of a batch file, to scan files in option --lint or
+          to process the chunks of option --chunk-days; default: 1
+      --engine <name> : the engine calculating options -w, -t, -c and
+          --plan-vs-actual: 'reference' or 'indexed', which only looks at
+          the days within the filter's time range for the work package
+          reports; default: reference
+      --verify-engine : calculate the work package reports, the time at work
+          overview and the day check with the engine of option --engine and
+          with the reference engine and report the first line that differs
+          in each
+      --chunk-days <count> : in options -t and -c, split the days of a log
+          without identities into chunks of <count> days that are processed
+          by the worker processes of option -j; the output is the same;
+          not used with option --rolling
+      --export-sqlite <file> : write days, activities, work packages,
+          directives and comments into a new SQLite database <file>;
+          all times are in minutes
+      --lint : only check the input files and their imports for errors and
+          warnings, without building days and activities; with -j the
+          files are scanned by parallel worker processes
+      --check-incremental : take each day within the filter's time range out
+          of the work package and period totals and put it back, and check
+          the totals against a full recompute
+      --compile-archive <file> : write the days within the filter's time range,
+          their activities and the work package tree into the compact
+          archive <file>; an archive ending in .tfa (or .tfa.gz and the
+          like, which get compressed) can be imported and read much faster
+          than the log files it was made from
+      --no-archive-text : in option --compile-archive, leave out the
+          activity descriptions and day comments
+      --from-sqlite <file> : take the input from a database written with
+          --export-sqlite instead of reading log files; only the days
+          within the filter's time range are loaded
 
     Examples:
     
@@ -1229,8 +4364,15 @@ class Application:
 def main(argv):
     app = Application()
     app.interpret_cmdline(argv)
-    app.read_files()
-    app.process()
+    if app.replay_cached():
+        return
+    completed = False
+    try:
+        app.read_files()
+        app.process()
+        completed = True
+    finally:
+        app.cache_result(completed)
     
 if __name__ == '__main__':
     main(sys.argv)